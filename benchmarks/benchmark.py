@@ -0,0 +1,329 @@
+#!python3
+
+# Measure how the path cleanup, dogboning and text rendering code
+# scales.
+#
+# Each benchmark runs one stage on synthetic input of several sizes
+# (or on every font built by hershey/build_fonts.py) and reports the
+# best wall time of a few runs, the peak memory allocated by Python
+# during a run and the number of path segments processed per second.  The results can be
+# saved as JSON and compared with an earlier run:
+#
+#   python benchmark.py --output before.json
+#   ... change something ...
+#   python benchmark.py --compare before.json
+
+import argparse
+import copy
+import datetime
+import glob
+import io
+import json
+import os.path
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+FONTS_DIR = os.path.join(REPO, 'hershey', 'fonts')
+
+sys.path.append(os.path.join(REPO, 'dogbones'))
+sys.path.append(os.path.join(REPO, 'hershey'))
+
+import xml.dom.minidom
+
+# pip install svg.path
+import svg.path
+
+import dogbones
+import path_cleanup
+import render_text
+
+# make_samples needs yattag.
+try:
+  import make_samples
+except ImportError:
+  make_samples = None
+
+
+def measure(setup, run, repeat):
+  '''measure calls run on the result of setup repeat times and returns
+  the shortest time taken, then does so once more to find the peak
+  memory allocated during run.'''
+  best = None
+  for unused in range(repeat):
+    arg = setup()
+    t0 = time.perf_counter()
+    run(arg)
+    elapsed = time.perf_counter() - t0
+    if best is None or elapsed < best:
+      best = elapsed
+  arg = setup()
+  tracemalloc.start()
+  run(arg)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return best, peak
+
+
+# Synthetic inputs
+
+def random_polylines(segments, seed=0):
+  '''random_polylines returns a path of about segments Lines forming
+  random polylines on an integer grid, as in a Hershey glyph, so that
+  many of them share endpoints.'''
+  rng = random.Random(seed)
+  parts = []
+  count = 0
+  while count < segments:
+    x = rng.randrange(100)
+    y = rng.randrange(100)
+    parts.append('M %d,%d' % (x, y))
+    for unused in range(min(rng.randrange(1, 12), segments - count)):
+      x += rng.randrange(-5, 6)
+      y += rng.randrange(-5, 6)
+      parts.append('L %d,%d' % (x, y))
+      count += 1
+  return ' '.join(parts)
+
+
+def mortise_d(i, j):
+  # An explicitly closed rectangle, so all four of its points are
+  # corners.
+  x = 2.0 * i
+  y = 1.5 * j
+  return 'M %g,%g L %g,%g L %g,%g L %g,%g L %g,%g' % (
+    x, y, x + 1, y, x + 1, y + 0.5, x, y + 0.5, x, y)
+
+
+def mortise_grid(segments):
+  '''mortise_grid returns the d attributes of a square grid of
+  rectangular mortises with about segments Lines in all.'''
+  side = max(1, int(round((segments / 4) ** 0.5)))
+  return [mortise_d(i, j) for i in range(side) for j in range(side)]
+
+
+def mortise_document(segments):
+  return '\n'.join(
+    ['<svg xmlns="http://www.w3.org/2000/svg">'] +
+    ['  <path d="%s"/>' % d for d in mortise_grid(segments)] +
+    ['</svg>', ''])
+
+
+def path_element(d):
+  return xml.dom.minidom.parseString('<path d="%s"/>' % d).documentElement
+
+
+def text_of_length(length, seed=0):
+  rng = random.Random(seed)
+  words = []
+  while sum(len(w) + 1 for w in words) < length:
+    words.append(''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+                         for unused in range(rng.randrange(1, 10))))
+  return ' '.join(words)[:length]
+
+
+# The fonts aren't checked in; hershey/build_fonts.py makes them.
+
+def raw_fonts(benchmark):
+  '''raw_fonts returns the file names of the fonts as written by
+  extract_font.py, warning that benchmark is skipped if there are
+  none.'''
+  fonts = sorted(f for f in glob.glob(os.path.join(FONTS_DIR, '*.json'))
+                 if not f.endswith('-cleaned_up.json'))
+  if not fonts:
+    warn_no_fonts(benchmark, 'extracted')
+  return fonts
+
+
+def cleaned_fonts(benchmark):
+  fonts = sorted(glob.glob(os.path.join(FONTS_DIR, '*-cleaned_up.json')))
+  if not fonts:
+    warn_no_fonts(benchmark, 'cleaned up')
+  return fonts
+
+
+def warn_no_fonts(benchmark, kind):
+  print('Skipping %s: there are no %s fonts in %s.  Make them with '
+        'hershey/build_fonts.py.' % (benchmark, kind, FONTS_DIR), file=sys.stderr)
+
+
+def font_segments(font):
+  '''font_segments counts the segments of the glyphs of font.'''
+  count = 0
+  for char in font['chars']:
+    for d in char['paths'] if 'paths' in char else [char['d']]:
+      count += sum(1 for step in svg.path.parse_path(d)
+                   if not isinstance(step, svg.path.Move))
+  return count
+
+
+# Benchmarks.  Each is a generator of (size, segments, setup, run)
+# tuples, where size describes the input, segments is the number of
+# path segments it has and setup and run are as for measure.  The
+# lambdas bind their inputs as default arguments so that each keeps
+# its own.
+
+BENCHMARKS = {}
+
+def benchmark(name):
+  def define(f):
+    BENCHMARKS[name] = f
+    return f
+  return define
+
+
+@benchmark('fix_path')
+def bench_fix_path(sizes):
+  for n in sizes:
+    d = random_polylines(n)
+    yield n, n, lambda d=d: svg.path.parse_path(d), path_cleanup.fix_path
+
+
+@benchmark('PathHolder')
+def bench_path_holder(sizes):
+  for n in sizes:
+    d = ' '.join(mortise_grid(n))
+    yield n, 4 * len(mortise_grid(n)), lambda d=d: path_element(d), dogbones.PathHolder
+
+
+@benchmark('make_dogbones')
+def bench_make_dogbones(sizes):
+  def setup(d):
+    ph = dogbones.PathHolder(path_element(d))
+    ph.choose_dogbones('bisector')
+    return ph
+  for n in sizes:
+    d = ' '.join(mortise_grid(n))
+    yield (n, 4 * len(mortise_grid(n)), lambda d=d: setup(d),
+           lambda ph: ph.make_dogbones())
+
+
+@benchmark('dogbone_stream')
+def bench_dogbone_stream(sizes):
+  for n in sizes:
+    document = mortise_document(n)
+    yield (n, 4 * len(mortise_grid(n)), lambda document=document: io.StringIO(document),
+           lambda reader: dogbones.dogbone_stream(reader, io.StringIO(), 'bisector'))
+
+
+@benchmark('cleanup_font_paths')
+def bench_cleanup_font_paths(sizes):
+  for f in raw_fonts('cleanup_font_paths'):
+    font = path_cleanup.load_font(f)
+    yield (os.path.basename(f), font_segments(font), lambda font=font: copy.deepcopy(font),
+           path_cleanup.cleanup_font_paths)
+
+
+@benchmark('write_sample')
+def bench_write_sample(sizes):
+  if make_samples is None:
+    print('Skipping write_sample: make_samples.py needs yattag.', file=sys.stderr)
+    return
+  out = os.path.join(tempfile.mkdtemp(), 'sample.html')
+  for f in raw_fonts('write_sample'):
+    font = make_samples.load_font(f)
+    yield (os.path.basename(f), font_segments(font), lambda font=font: font,
+           lambda font: make_samples.write_sample(font, out))
+
+
+@benchmark('render_text')
+def bench_render_text(sizes):
+  for f in cleaned_fonts('render_text'):
+    font = render_text.load_font(f)
+    for n in sizes:
+      text = text_of_length(n)
+      renderer = render_text.TextRenderer(font)
+      segments = sum(len(p) - 1 for p in renderer.paths(text))
+      yield ('%s %d chars' % (os.path.basename(f), n), segments,
+             lambda font=font: render_text.TextRenderer(font),
+             lambda renderer, text=text: renderer.svg_document(text))
+
+
+def run_benchmarks(names, sizes, repeat):
+  results = []
+  for name in names:
+    for size, segments, setup, run in BENCHMARKS[name](sizes):
+      seconds, peak = measure(setup, run, repeat)
+      result = {
+        'benchmark': name,
+        'size': size,
+        'segments': segments,
+        'seconds': seconds,
+        'peak_bytes': peak,
+        'segments_per_second': segments / seconds if seconds else None,
+      }
+      print('%-20s %-40s %8d segments %9.4f s %10.0f segments/s %8.1f MB peak' % (
+        name, size, segments, seconds, result['segments_per_second'] or 0,
+        peak / 1e6))
+      results.append(result)
+  return results
+
+
+def compare(results, baseline):
+  '''compare prints the time of each result relative to the
+  corresponding one in baseline.'''
+  before = {(r['benchmark'], str(r['size'])): r for r in baseline['results']}
+  print('\nCompared with %s:' % baseline['time'])
+  for r in results:
+    old = before.get((r['benchmark'], str(r['size'])))
+    if old is None or not old['seconds']:
+      continue
+    ratio = r['seconds'] / old['seconds']
+    print('%-20s %-40s %9.4f s was %9.4f s  x%.2f%s' % (
+      r['benchmark'], r['size'], r['seconds'], old['seconds'], ratio,
+      '  SLOWER' if ratio > 1.1 else ''))
+
+
+parser = argparse.ArgumentParser(description='Benchmark path cleanup, dogboning and text rendering.')
+
+parser.add_argument('benchmark', type=str, nargs='*', action='store',
+                    help='The benchmarks to run, from %s.  The default is all of them.' %
+                    ', '.join(BENCHMARKS))
+
+parser.add_argument('--sizes', type=int, nargs='+', action='store',
+                    default=[100, 1000, 10000],
+                    help='Input sizes: numbers of segments, or characters for render_text.')
+
+parser.add_argument('--repeat', type=int, nargs=None, action='store', default=3,
+                    help='Report the best of this many runs.')
+
+parser.add_argument('--output', type=str, nargs=None, action='store',
+                    help='Write the results to this JSON file.')
+
+parser.add_argument('--compare', type=str, nargs=None, action='store',
+                    help='A JSON file from an earlier run to compare the results with.')
+
+
+def main():
+  args = parser.parse_args()
+  names = args.benchmark or list(BENCHMARKS)
+  for name in names:
+    if not name in BENCHMARKS:
+      parser.error('Unknown benchmark %r' % name)
+  # Import numpy now, rather than in the first timed run that uses it.
+  have_numpy = dogbones.load_numpy()
+  results = run_benchmarks(names, args.sizes, args.repeat)
+  report = {
+    'time': datetime.datetime.now().isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'numpy': have_numpy,
+    'sizes': args.sizes,
+    'repeat': args.repeat,
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w') as out:
+      json.dump(report, out, indent=2)
+  if args.compare:
+    with open(args.compare, 'r') as f:
+      compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+  main()
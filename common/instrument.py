@@ -0,0 +1,250 @@
+# Profiling and stage timing for the command line tools.
+#
+# A tool adds the --profile and --timings arguments to its parser with
+# add_arguments and runs its work inside a session:
+#
+#   args = parser.parse_args()
+#   with instrument.session('my_tool', args):
+#     ...
+#
+# --profile FILE writes a cProfile dump of the session to FILE, which
+# can be read with pstats or snakeviz.
+#
+# --timings FILE appends one line of JSON to FILE (- for standard
+# error) when the session ends, so that it can be collected from batch
+# jobs.  It has the wall time of the session, the wall time and number
+# of calls of each stage, counts of the things processed and the peak
+# resident set size of this process and of its worker processes.
+# Stages are marked in the code with
+#
+#   with instrument.stage('parse_path'):
+#     ...
+#
+# and counts with instrument.count('paths').  Stages may nest, so
+# their times need not add up to the total.  When timings aren't being
+# kept these cost next to nothing.
+#
+# Work given to a process pool is timed in the worker.  Use executor to
+# make the pool and submit and result rather than the methods of the
+# pool so that the worker's timings are added to this process's.
+# While profiling, executor runs the work in this process instead, so
+# that the profile covers all of it.  It does so too when there is only
+# one worker, since starting a process for it would only add time.
+# Given the number of tasks, executor doesn't start more workers than
+# will have work to do.
+#
+# This is used by dogbones/dogbones.py, hershey/path_cleanup.py and
+# hershey/make_samples.py.
+
+import concurrent.futures
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+# resource isn't available on Windows.
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+class Timings(object):
+  '''Timings accumulates the wall time and number of calls of each
+  stage and the counts of things processed by one process.'''
+  def __init__(self):
+    self.pid = os.getpid()
+    self.seconds = defaultdict(float)
+    self.calls = defaultdict(int)
+    self.counts = defaultdict(int)
+
+  def state(self):
+    return (dict(self.seconds), dict(self.calls), dict(self.counts))
+
+  def add(self, state):
+    '''add adds the state of another Timings to this one.'''
+    seconds, calls, counts = state
+    for name, s in seconds.items():
+      self.seconds[name] += s
+    for name, n in calls.items():
+      self.calls[name] += n
+    for name, n in counts.items():
+      self.counts[name] += n
+
+
+class Stage(object):
+  def __init__(self, timings, name):
+    self.timings = timings
+    self.name = name
+
+  def __enter__(self):
+    self.t0 = time.perf_counter()
+
+  def __exit__(self, *exc_info):
+    self.timings.seconds[self.name] += time.perf_counter() - self.t0
+    self.timings.calls[self.name] += 1
+
+
+NO_STAGE = contextlib.nullcontext()
+
+# The Timings of the current session, or None if timings aren't being
+# kept.
+timings = None
+
+# The profiler of the current session, or None.
+profiler = None
+
+
+def stage(name):
+  '''stage returns a context manager that adds the time spent in it to
+  the stage name.'''
+  if timings is None:
+    return NO_STAGE
+  return Stage(timings, name)
+
+
+def count(name, n=1):
+  '''count adds n to the count of name.'''
+  if timings is not None:
+    timings.counts[name] += n
+
+
+def peak_rss(children=False):
+  '''peak_rss returns the peak resident set size in bytes of this
+  process, or the largest of its terminated child processes, or None if
+  that isn't known.'''
+  if resource is None:
+    return None
+  rusage = resource.getrusage(resource.RUSAGE_CHILDREN if children
+                              else resource.RUSAGE_SELF)
+  # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+  if sys.platform == 'darwin':
+    return rusage.ru_maxrss
+  return rusage.ru_maxrss * 1024
+
+
+def add_arguments(parser):
+  parser.add_argument('--profile', type=str, nargs=None, action='store',
+                      metavar='FILE',
+                      help='Write a cProfile dump to FILE.  Worker processes ' +
+                      'are not used while profiling.')
+  parser.add_argument('--timings', type=str, nargs=None, action='store',
+                      metavar='FILE',
+                      help='Append the time spent in each stage, counts of the ' +
+                      'paths, corners and segments processed and peak memory use ' +
+                      'to FILE as a line of JSON.  - is standard error.')
+
+
+@contextlib.contextmanager
+def session(tool, args):
+  '''session keeps timings and profiles the work done in its body as
+  asked by args, which has the attributes made by add_arguments.'''
+  global timings, profiler
+  if args.timings:
+    timings = Timings()
+  if args.profile:
+    import cProfile
+    profiler = cProfile.Profile()
+  t0 = time.perf_counter()
+  if profiler is not None:
+    profiler.enable()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - t0
+    if profiler is not None:
+      profiler.disable()
+      profiler.dump_stats(args.profile)
+    if timings is not None:
+      write_report(tool, elapsed, args.timings)
+    timings = None
+    profiler = None
+
+
+def write_report(tool, elapsed, filename):
+  report = {
+    'tool': tool,
+    'argv': sys.argv[1:],
+    'pid': timings.pid,
+    'seconds': elapsed,
+    'stages': {name: {'seconds': timings.seconds[name],
+                      'calls': timings.calls[name]}
+               for name in timings.seconds},
+    'counts': dict(timings.counts),
+    'peak_rss_bytes': peak_rss(),
+    'workers_peak_rss_bytes': peak_rss(children=True),
+  }
+  line = json.dumps(report, sort_keys=True)
+  if filename == '-':
+    print(line, file=sys.stderr)
+  else:
+    with open(filename, 'a') as out:
+      out.write(line + '\n')
+
+
+class InlineExecutor(concurrent.futures.Executor):
+  '''InlineExecutor does the work submitted to it right away, in the
+  calling process.'''
+  def __init__(self, initializer=None, initargs=()):
+    if initializer is not None:
+      initializer(*initargs)
+
+  def submit(self, fn, *args, **kwargs):
+    future = concurrent.futures.Future()
+    try:
+      future.set_result(fn(*args, **kwargs))
+    except Exception as err:
+      future.set_exception(err)
+    return future
+
+
+def executor(max_workers=None, initializer=None, initargs=(), tasks=None):
+  '''executor returns a ProcessPoolExecutor, or an InlineExecutor while
+  profiling or if max_workers is 1.  If the number of tasks to be
+  submitted is given, the pool has no more workers than that, and as
+  many if max_workers is None.'''
+  if tasks is not None:
+    max_workers = max(1, min(max_workers or tasks, tasks))
+  if profiler is not None or max_workers == 1:
+    return InlineExecutor(initializer, initargs)
+  return concurrent.futures.ProcessPoolExecutor(
+    max_workers=max_workers, initializer=initializer, initargs=initargs)
+
+
+def collect(fn, args):
+  '''collect calls fn with args, keeping timings, and returns its value
+  and the state of those timings.  If it is called in the process that
+  is keeping timings they are kept there instead.'''
+  global timings
+  if timings is not None and timings.pid == os.getpid():
+    return fn(*args), None
+  # A forked worker process inherits the timings of its parent.
+  timings = Timings()
+  try:
+    return fn(*args), timings.state()
+  finally:
+    timings = None
+
+
+def submit(pool, fn, *args):
+  '''submit is like pool.submit except that, when timings are being
+  kept, they are also kept for fn.  Get the value with result.'''
+  if timings is None:
+    return pool.submit(fn, *args)
+  future = pool.submit(collect, fn, args)
+  future.timed = True
+  return future
+
+
+def result(future):
+  '''result returns the result of a future from submit, adding the
+  timings of the work to those of this process.'''
+  value = future.result()
+  if not getattr(future, 'timed', False):
+    return value
+  value, state = value
+  if state is not None and timings is not None:
+    timings.add(state)
+  return value
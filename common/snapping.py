@@ -0,0 +1,57 @@
+# Snap nearly coincident points together.
+#
+# Endpoints that ought to be the same point often differ by a little
+# floating point noise, after parsing, transforming or conversion by
+# another program.  A Snapper replaces each point it is given by the
+# first point it has seen within tolerance of it, so that endpoints
+# can then be matched by simple equality.
+#
+# Points are complex numbers, as in svg.path.  The points seen so far
+# are kept in a grid of square cells tolerance on a side, so only the
+# nine cells around a point need be searched.  Snapping n points takes
+# time proportional to n.
+#
+# This is used by both dogbones/dogbones.py and hershey/path_cleanup.py.
+
+import math
+
+
+DEFAULT_TOLERANCE = 0.0001
+
+
+class Snapper(object):
+  '''Snapper snaps each point to the nearest point within tolerance of
+  it that it has already seen.'''
+  def __init__(self, tolerance=DEFAULT_TOLERANCE):
+    self.tolerance = tolerance
+    self.cells = {}
+
+  def cell(self, point):
+    return (math.floor(point.real / self.tolerance),
+            math.floor(point.imag / self.tolerance))
+
+  def snap(self, point):
+    '''snap returns the point that point should be replaced by.'''
+    if self.tolerance <= 0:
+      return point
+    cx, cy = self.cell(point)
+    closest = None
+    for i in (cx - 1, cx, cx + 1):
+      for j in (cy - 1, cy, cy + 1):
+        for p in self.cells.get((i, j), ()):
+          d = abs(p - point)
+          if d <= self.tolerance and (closest is None or d < closest[0]):
+            closest = (d, p)
+    if closest is not None:
+      return closest[1]
+    self.cells.setdefault((cx, cy), []).append(point)
+    return point
+
+
+def snap_lines(lines, tolerance=DEFAULT_TOLERANCE):
+  '''snap_lines snaps together the endpoints of lines, which can be
+  any path segments with start and end points, in place.'''
+  snapper = Snapper(tolerance)
+  for line in lines:
+    line.start = snapper.snap(line.start)
+    line.end = snapper.snap(line.end)
@@ -4,30 +4,120 @@
 
 import argparse
 import cmath
+import concurrent.futures
+import contextlib
+import glob
+import io
 import math
+import os
 import os.path
+import re
 import sys
-import tkinter
+import time
 import xml.dom
 import xml.dom.minidom
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 # pip install svg.path
 import svg.path
 
-
-# Initially these are default values for command line arguments.  main
-# sets these globals from the command line inputs.
-
-# The diameter of the router bit
-cutter_diameter = 0.125
-
-# Give the dogbone some minimal width to appease Shaper Origin
-dogbone_base = 0.005
-
-# Extra length to be added to the calculated length of the dogbones if
-# the calculated length is found to not be sufficient
-extra = 0.0
+# snapping.py and instrument.py are shared with the hershey tools.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import instrument
+import snapping
+
+# numpy is optional.  With it the corners and dogbones of large paths
+# are computed a whole path at a time.  Importing it takes longer than
+# dogboning a small file, so that is put off by load_numpy until a path
+# big enough to need it turns up.
+numpy = None
+numpy_loaded = False
+
+def load_numpy():
+  '''load_numpy imports numpy if that hasn't been tried yet.  It
+  returns true if numpy is available.'''
+  global numpy
+  global numpy_loaded
+  if not numpy_loaded:
+    try:
+      import numpy
+    except ImportError:
+      numpy = None
+    numpy_loaded = True
+  return numpy is not None
+
+
+# rectangle: a rectangular extension the width of the cutter.
+# arc: a circular arc just big enough for the cutter.
+DOGBONE_STYLES = ('rectangle', 'arc')
+
+
+class DogboneConfig (object):
+  '''DogboneConfig holds the parameters that control dogbone size and
+  shape, endpoint snapping and which corners get dogbones.  The
+  defaults are those of the command line arguments.  A DogboneConfig
+  shouldn't be changed once it is in use; make another with replace
+  instead.  That way any number of configurations can be used at once,
+  from several threads.'''
+  def __init__(self,
+               # The diameter of the router bit
+               cutter_diameter=0.125,
+               # Give the dogbone some minimal width to appease Shaper
+               # Origin
+               dogbone_base=0.005,
+               # Extra length to be added to the calculated length of
+               # the dogbones if the calculated length is found to not
+               # be sufficient
+               extra=0.0,
+               # The shape of the dogbones: one of DOGBONE_STYLES.
+               style='rectangle',
+               # Path endpoints closer together than this are taken to
+               # be the same point.
+               snap_tolerance=snapping.DEFAULT_TOLERANCE,
+               # Corners where the path turns by less than this many
+               # degrees are not offered dogbones.
+               min_angle=5.0,
+               # The cut type of paths that have no shaper:cutType
+               # attribute, or None to offer dogbones at every corner
+               # of such paths.  See CUT_TYPE_SIDES.
+               default_cut_type=None,
+               # Two consecutive lines are merged into one if the sine
+               # of the angle between them is no more than this.
+               collinear_tolerance=1e-6):
+    if not style in DOGBONE_STYLES:
+      raise ValueError('Unknown dogbone style %r, expected one of %s' %
+                       (style, ', '.join(DOGBONE_STYLES)))
+    # An arc dogbone is the circle the cutter cuts when it reaches the
+    # corner.  Moving that circle any further would take it off one leg
+    # or the other.
+    if style == 'arc' and extra:
+      raise ValueError('extra can not be used with the arc style')
+    if default_cut_type and not default_cut_type in CUT_TYPE_SIDES:
+      raise ValueError('Unknown cut type %r, expected one of %s' %
+                       (default_cut_type, ', '.join(CUT_TYPE_SIDES)))
+    self.cutter_diameter = cutter_diameter
+    self.dogbone_base = dogbone_base
+    self.extra = extra
+    self.style = style
+    self.snap_tolerance = snap_tolerance
+    self.min_angle = min_angle
+    self.default_cut_type = default_cut_type
+    self.collinear_tolerance = collinear_tolerance
+
+  def __repr__(self):
+    return '%s(%s)' % (self.__class__.__name__, ', '.join(
+      '%s=%r' % item for item in sorted(self.__dict__.items())))
+
+  def replace(self, **changes):
+    '''replace returns a DogboneConfig like this one but with the
+    given parameters changed.'''
+    parameters = dict(self.__dict__)
+    parameters.update(changes)
+    return DogboneConfig(**parameters)
+
+
+DEFAULT_CONFIG = DogboneConfig()
 
 parser = argparse.ArgumentParser(description='''Add dogbones to an SVG file of Shaper Origin cut paths.
 
@@ -36,24 +126,72 @@ The selected direction turns green.  Click near a corner but not on a dot
 to cancel the dogbone for that corner.
 After closing the window a new SVG file with the dogbones will be written.
 
+With --batch no window is shown.  Instead the dogbone direction of each
+corner is chosen by a rule (see --default_rule and --rule) and the new
+SVG file is written immediately.  In batch mode the input files are
+processed in parallel (see --jobs).
+
 Source code is at
 https://github.com/MarkNahabedian/DesignWithSVG/tree/master/dogbones
 ''')
 
-parser.add_argument('input_file', type=str, nargs=None, action='store',
-                    help='An SVG file of cut paths for Shaper Origin.')
+parser.add_argument('input_file', type=str, nargs='*', action='store',
+                    help='An SVG file of cut paths for Shaper Origin.  ' +
+                    'Directories and glob patterns are expanded to the SVG files they contain.')
 
 parser.add_argument('--cutter_diameter', type=float, nargs=None, action='store',
-                    default=cutter_diameter,
+                    default=DEFAULT_CONFIG.cutter_diameter,
                     help='Diameter of the cutter bit.')
 
 parser.add_argument('--dogbone_base', type=float, nargs=None, action='store',
-                    default=dogbone_base,
+                    default=DEFAULT_CONFIG.dogbone_base,
                     help='The width of the dogbone at the corner it extends from.')
 
 parser.add_argument('--extra', type=float, nargs=None, action='store',
-                    default=extra,
-                    help='Additional depth to be added to each dogbone.')
+                    default=DEFAULT_CONFIG.extra,
+                    help='Additional depth to be added to each dogbone.  ' +
+                    'Not used with --style arc.')
+
+parser.add_argument('--style', type=str, nargs=None, action='store',
+                    default=DEFAULT_CONFIG.style, choices=DOGBONE_STYLES,
+                    help='The shape of the dogbones.  With arc, a dogbone along the ' +
+                    'bisector of a corner is round and one along a leg is a T-bone.')
+
+parser.add_argument('--min_angle', type=float, nargs=None, action='store',
+                    default=DEFAULT_CONFIG.min_angle,
+                    help='Corners where the path turns by fewer degrees than this get no dogbone.')
+
+parser.add_argument('--cut_type', type=str, nargs=None, action='store',
+                    default=DEFAULT_CONFIG.default_cut_type,
+                    help='The Shaper Origin cut type (inside, outside, pocket, online, ' +
+                    'guide) of paths without a shaper:cutType attribute.  Only the ' +
+                    'internal corners of closed paths that are cut inside or outside ' +
+                    'get dogbones, and paths cut online or guides get none.')
+
+parser.add_argument('--tolerance', type=float, nargs=None, action='store',
+                    default=DEFAULT_CONFIG.snap_tolerance,
+                    help='Path endpoints closer together than this are taken to be the same point.')
+
+parser.add_argument('--batch', action='store_true',
+                    help='Choose dogbones by rule rather than interactively.')
+
+parser.add_argument('--default_rule', type=str, nargs=None, action='store',
+                    default='bisector',
+                    help='In batch mode, the rule for paths not matched by --rule.')
+
+parser.add_argument('--rule', type=str,
+                    action='append', default=[], metavar='CLASS=RULE',
+                    help='In batch mode, use RULE for paths having the SVG class CLASS.  ' +
+                    'May be repeated.')
+
+parser.add_argument('--jobs', type=int, nargs=None, action='store',
+                    default=os.cpu_count(),
+                    help='In batch mode, the number of files to process at once.')
+
+parser.add_argument('--test', action='store_true',
+                    help='Run the self tests first.')
+
+instrument.add_arguments(parser)
 
 
 # Distance from a corner point to its direction selection dots in SVG
@@ -81,7 +219,12 @@ def distance(cplx1, cplx2):
   return abs(cplx2 - cplx1)
 
 def unitVector(cplx):
-  return cplx / cmath.polar(cplx)[0]
+  # This is spelled out, rather than cplx / abs(cplx), so that
+  # unitVectors can round it exactly the same way.
+  x = pointX(cplx)
+  y = pointY(cplx)
+  length = math.sqrt(x * x + y * y)
+  return cplxPoint(x / length, y / length)
 
 def perpendicular(cplx):
   return cplxPoint(- pointY(cplx), pointX(cplx))
@@ -105,40 +248,169 @@ class Transformer (object):
   def toCanvas(self, x, y):
     return self.xOffset + self.scale * float(x), self.yOffset + self.scale * float(y)
 
+  def zoom(self, factor, x, y):
+    '''Scale by factor, keeping the canvas point x, y where it is.'''
+    svgX, svgY = self.toSVG(x, y)
+    self.scale *= factor
+    self.xOffset = float(x) - self.scale * svgX
+    self.yOffset = float(y) - self.scale * svgY
 
-transformer = Transformer()
+  def pan(self, dx, dy):
+    '''Move the drawing by dx, dy in canvas coordinates.'''
+    self.xOffset += dx
+    self.yOffset += dy
 
+  def fit(self, bbox, width, height, margin=20.0):
+    '''Scale and position the SVG bounding box bbox, (minX, minY, maxX,
+    maxY), to fill a canvas of width by height.'''
+    minX, minY, maxX, maxY = bbox
+    spanX = max(maxX - minX, 1e-6)
+    spanY = max(maxY - minY, 1e-6)
+    self.scale = min((width - 2 * margin) / spanX,
+                     (height - 2 * margin) / spanY)
+    self.xOffset = (width - self.scale * (minX + maxX)) / 2
+    self.yOffset = (height - self.scale * (minY + maxY)) / 2
 
-def cleanupPath(p):
-  '''svg.path.Path has some quirks which are problematic for us.
-     We try to address those here.'''
-  for step in p:
-    if isinstance(step, svg.path.Line):
-      cleanupLine(step)
-      # Remove zero length lines
-      if step.length() == 0.0:
-        p.remove(step)
 
-# svg.path seems to produce a lot of ridiculous floating point numbers
-# that don't quite match each other from line to line.  Here we round
-# line endpoints to the nearest 0.0001.
+# The Transformer of the GUI.
+transformer = None
 
-def cleanupLine(line):
-  line.start = cleanupPoint(line.start)
-  line.end = cleanupPoint(line.end)
 
-def cleanupPoint(cmplx):
-  return cplxPoint(cleanupFloat(pointX(cmplx)),
-                   cleanupFloat(pointY(cmplx)))
+class CleanupStats (object):
+  '''CleanupStats counts the Lines that cleanupPath removed.'''
+  def __init__(self):
+    self.zero_length = 0
+    self.collinear = 0
+    self.duplicate = 0
+
+  def total(self):
+    return self.zero_length + self.collinear + self.duplicate
 
-def cleanupFloat(f):
-  return round(f, 4)
+  def add(self, other):
+    self.zero_length += other.zero_length
+    self.collinear += other.collinear
+    self.duplicate += other.duplicate
+
+  def __str__(self):
+    return "%d zero length, %d collinear and %d duplicate lines removed" % (
+      self.zero_length, self.collinear, self.duplicate)
+
+
+def lineKey(line):
+  '''lineKey returns the same key for Lines with the same endpoints,
+  whichever way round.'''
+  a = (pointX(line.start), pointY(line.start))
+  b = (pointX(line.end), pointY(line.end))
+  return (a, b) if a <= b else (b, a)
+
+def collinear(line1, line2, tolerance):
+  '''collinear is true if line2 continues straight on from line1: if
+  the sine of the angle between them is no more than tolerance.'''
+  v1 = line1.end - line1.start
+  v2 = line2.end - line2.start
+  # The real part of this is the dot product of v1 and v2, the
+  # imaginary part their cross product.
+  product = v1.conjugate() * v2
+  return (pointX(product) > 0 and
+          abs(pointY(product)) <= tolerance * abs(v1) * abs(v2))
+
+def cleanupPath(p, config=DEFAULT_CONFIG):
+  '''svg.path.Path has some quirks which are problematic for us.
+     We try to address those here.  Lines of zero length and Lines that
+     duplicate an earlier Line are removed, and a Line that continues
+     straight on from the one before it is merged into it.  The path is
+     rebuilt once, in time proportional to its length.  The tolerances
+     come from config, a DogboneConfig.  Returns a CleanupStats.'''
+  stats = CleanupStats()
+  steps = list(p)
+  # svg.path seems to produce a lot of ridiculous floating point numbers
+  # that don't quite match each other from line to line.  Here we snap
+  # together endpoints that are within snap_tolerance of each other.
+  snapping.snap_lines([step for step in steps if isinstance(
+    step, (svg.path.Line, svg.path.Move, svg.path.Close))], config.snap_tolerance)
+  # First decide which Lines to drop and count how many of those kept
+  # end at each point.  Lines are only merged at a point where nothing
+  # else meets them.
+  dropped = set()
+  seen = set()
+  ends = defaultdict(int)
+  for step in steps:
+    if isinstance(step, svg.path.Line):
+      if step.start == step.end:
+        stats.zero_length += 1
+        dropped.add(id(step))
+        continue
+      key = lineKey(step)
+      if key in seen:
+        stats.duplicate += 1
+        dropped.add(id(step))
+        continue
+      seen.add(key)
+      ends[step.start] += 1
+      ends[step.end] += 1
+  segments = []
+  # position is the current point and subpath_start where Close returns
+  # to.  broken is true if a Move has been added since subpath_start
+  # because a dropped Line left a gap.
+  position = None
+  subpath_start = None
+  broken = False
+  for step in steps:
+    if isinstance(step, svg.path.Move):
+      if segments and isinstance(segments[-1], svg.path.Move):
+        segments.pop()
+      segments.append(step)
+      position = subpath_start = step.end
+      broken = False
+      continue
+    if id(step) in dropped:
+      continue
+    if isinstance(step, svg.path.Close):
+      if position != step.start:
+        # The Lines before the Z were dropped.  Keep only what the Z
+        # itself draws, if anything.
+        line = svg.path.Line(step.start, step.end)
+        if step.start == step.end:
+          continue
+        if lineKey(line) in seen:
+          stats.duplicate += 1
+          continue
+        segments.append(svg.path.Move(step.start))
+        segments.append(line)
+        position = step.end
+        broken = True
+        continue
+      if broken:
+        # Z would now return to the wrong place.
+        step = svg.path.Line(position, subpath_start)
+      else:
+        step.start = position
+      segments.append(step)
+      position = subpath_start
+      continue
+    if position is not None and step.start != position:
+      segments.append(svg.path.Move(step.start))
+      broken = True
+    previous = segments[-1] if segments else None
+    if (isinstance(step, svg.path.Line) and
+        isinstance(previous, svg.path.Line) and
+        ends[step.start] == 2 and
+        collinear(previous, step, config.collinear_tolerance)):
+      previous.end = step.end
+      stats.collinear += 1
+    else:
+      segments.append(step)
+    position = step.end
+  p[:] = segments
+  return stats
 
 
 class Corner (object):
-  '''Corner represents a single corner in an SVG path.'''
-  def __init__(self, pathholder, cplxpoint, line1, line2):
+  '''Corner represents a single corner in an SVG path.  Its dogbone is
+  made as config, a DogboneConfig, says.'''
+  def __init__(self, pathholder, cplxpoint, line1, line2, config=DEFAULT_CONFIG):
     self.pathholder = pathholder
+    self.config = config
     self.x = pointX(cplxpoint)
     self.y = pointY(cplxpoint)
     # line1 should end at the Corner and line2 should start at the Corner
@@ -151,6 +423,9 @@ class Corner (object):
     # dogbone_direction is None or a unit vector in the direction the
     # dogbone should be cut.
     self.dogbone_direction = None
+    # directionDots and dotLocations cache their results here.
+    self.direction_dots = None
+    self.dot_locations = None
 
   def cplxPoint(self):
     return cplxPoint(self.x, self.y)
@@ -163,9 +438,44 @@ class Corner (object):
   def __str__(self):
     return "%s(%f, %f, %r %r %r)" % (self.__class__.__name__, self.x, self.y, self.dogbone_direction, self.line1, self.line2)
 
+  def turn(self):
+    '''Returns the angle in radians through which the path turns at
+    the corner, positive for a turn toward the positive Y axis.'''
+    return cmath.phase((self.line2.end - self.line2.start) /
+                       (self.line1.end - self.line1.start))
+
+  def isInternal(self, areas, cut_type):
+    '''isInternal is true if the corner might need a dogbone.  areas
+    is the result of subpathAreas for the corner's path and cut_type
+    the Shaper Origin cut type of the path.'''
+    turn = self.turn()
+    if abs(math.degrees(turn)) < self.config.min_angle:
+      return False
+    if not cut_type:
+      return True
+    side = CUT_TYPE_SIDES.get(cut_type)
+    if side is None:
+      # The cutter is centred on the path, or doesn't cut at all.
+      return False
+    area = areas.get(id(self.line1))
+    if not area or areas.get(id(self.line2)) != area:
+      # We can't tell which side the cutter is on.
+      return True
+    # A closed subpath with positive area has its inside to the left,
+    # so a turn to the left is a convex corner of the shape.  The
+    # cutter can't get into a convex corner from inside the shape or a
+    # concave one from outside.
+    convex = (turn > 0) == (area > 0)
+    return convex == (side == 'inside')
+
   def directionDots(self):
     '''Returns the unit vectors (as complex points) in the directions that
     # a dogbone from the corner might go in.'''
+    if self.direction_dots is None:
+      self.direction_dots = self.computeDirectionDots()
+    return self.direction_dots
+
+  def computeDirectionDots(self):
     # Unit vectors along legs, pointing away from the corner
     l1 = unitVector(self.line1.start - self.line1.end)
     l2 = unitVector(self.line2.end - self.line2.start)
@@ -179,11 +489,23 @@ class Corner (object):
   def dotLocation(self, uv):
     return self.cplxPoint() + direction_dot_distance * uv
 
-  def make_dogbone(self):
-    if self.dogbone_direction is None: return
-    cutter_radius = cutter_diameter * 0.5
-    length = (cutter_radius + extra) * self.dogbone_direction
-    width = (cutter_diameter + dogbone_base) * perpendicular(self.dogbone_direction)
+  def dotLocations(self):
+    '''Returns (unit vector, dot location) pairs for the direction dots.'''
+    if self.dot_locations is None:
+      self.dot_locations = tuple((uv, self.dotLocation(uv))
+                                 for uv in self.directionDots())
+    return self.dot_locations
+
+  def dogbone_geometry(self):
+    '''Returns the points of the dogbone as a tuple of complex points:
+    the new end of line1, the two far corners of the dogbone and the
+    new start of line2.  Returns None if there is no dogbone.'''
+    if self.dogbone_direction is None: return None
+    config = self.config
+    cutter_radius = config.cutter_diameter * 0.5
+    length = (cutter_radius + config.extra) * self.dogbone_direction
+    width = ((config.cutter_diameter + config.dogbone_base) *
+             perpendicular(self.dogbone_direction))
     # Width should have the same sign as the transition from the first
     # leg of the corner to the second
     vector1 = unitVector(self.line1.end - self.line1.start)
@@ -201,121 +523,864 @@ class Corner (object):
       line_unit_vector = unitVector(line.end - line.start)
       b = line_unit_vector * dotProduct(line_unit_vector, width)
       return b
+    end1 = self.line1.end - backoff(self.line1)
+    start2 = self.line2.start + backoff(self.line2)
+    return (end1, end1 + length, start2 + length, start2)
+
+  def arc_dogbone(self):
+    '''Returns the new end of line1, an svg.path.Arc for the dogbone and
+    the new start of line2, or None if there is no dogbone.  The Arc is
+    part of the smallest circle the cutter fits in that reaches the
+    corner.  The circle's centre is found by reflecting the dogbone
+    direction across the bisector of the corner, so a dogbone along
+    the bisector is the classic round dogbone and one along either leg
+    is a T-bone.'''
+    if self.dogbone_direction is None: return None
+    config = self.config
+    radius = (config.cutter_diameter + config.dogbone_base) * 0.5
+    # Unit vectors along legs, pointing away from the corner
+    l1 = unitVector(self.line1.start - self.line1.end)
+    l2 = unitVector(self.line2.end - self.line2.start)
+    l45 = unitVector(l1 + l2)
+    # Reflecting a unit vector v across l45 gives l45 * l45 * conj(v).
+    toward_centre = l45 * l45 * (-self.dogbone_direction).conjugate()
+    centre = self.cplxPoint() + radius * toward_centre
+    def leaveCircle(corner, leg):
+      # Where the leg from corner in direction leg leaves the circle.
+      d = corner - centre
+      b = dotProduct(leg, d)
+      discriminant = b * b - abs(d) ** 2 + radius * radius
+      if discriminant < 0:
+        # A T-bone's circle just touches the other leg at a right
+        # angled corner, which rounding can turn into a near miss.
+        if discriminant < -1e-9 * radius * radius:
+          raise ValueError('Dogbone at %s does not meet its legs' % corner)
+        discriminant = 0.0
+      return corner + (math.sqrt(discriminant) - b) * leg
+    end1 = leaveCircle(self.line1.end, l1)
+    start2 = leaveCircle(self.line2.start, l2)
+    # The arc goes the way round the circle that passes through the
+    # point farthest from the centre in the dogbone direction.
+    farthest = centre + radius * self.dogbone_direction
+    def angle(point):
+      return cmath.phase(point - centre)
+    to_farthest = (angle(farthest) - angle(end1)) % (2 * math.pi)
+    to_start2 = (angle(start2) - angle(end1)) % (2 * math.pi)
+    sweep = to_farthest < to_start2
+    span = to_start2 if sweep else 2 * math.pi - to_start2
+    return (end1,
+            svg.path.Arc(end1, cplxPoint(radius, radius), 0, span > math.pi,
+                         sweep, start2),
+            start2)
+
+  def dogbone_segments(self):
+    '''Returns the new end of line1, a tuple of the path segments of the
+    dogbone in the style of the Corner's config, and the new start of
+    line2, or None if there is no dogbone.'''
+    if self.config.style == 'arc':
+      dogbone = self.arc_dogbone()
+      return dogbone and (dogbone[0], (dogbone[1],), dogbone[2])
+    return rectangleSegments(self.dogbone_geometry())
+
+  def make_dogbone(self):
+    dogbone = self.dogbone_segments()
+    if dogbone is None: return
+    end1, segments, start2 = dogbone
     # The segments of a parsed path appear to be properly ordered.  We assume this below.
     insertion_index = self.pathholder.parsed_path.index(self.line1)
-    self.line1.end = self.line1.end - backoff(self.line1)
-    self.line2.start = self.line2.start + backoff(self.line2)
-    dogbone1 = self.line1.end + length
-    dogbone2 = self.line2.start + length
-    self.pathholder.parsed_path.insert(
-      insertion_index + 1, 
-      svg.path.Line(self.line1.end, dogbone1))
-    # It would be more elegant to use a circular arc, but I'm lazy.
-    self.pathholder.parsed_path.insert(
-      insertion_index + 2, 
-      svg.path.Line(dogbone1, dogbone2))
-    self.pathholder.parsed_path.insert(
-      insertion_index + 3, 
-      svg.path.Line(dogbone2, self.line2.start))
+    self.line1.end = end1
+    self.line2.start = start2
+    # If line2 begins a subpath, its Move must follow it.
+    line2_index = self.pathholder.parsed_path.index(self.line2)
+    if line2_index > 0:
+      move = self.pathholder.parsed_path[line2_index - 1]
+      if isinstance(move, svg.path.Move):
+        move.start = move.end = start2
+    # The legs have changed.
+    self.direction_dots = None
+    self.dot_locations = None
+    for i, segment in enumerate(segments):
+      self.pathholder.parsed_path.insert(insertion_index + 1 + i, segment)
+
+
+def rectangleSegments(geometry):
+  '''rectangleSegments turns the result of Corner.dogbone_geometry
+  into that of Corner.dogbone_segments.'''
+  if geometry is None:
+    return None
+  end1, dogbone1, dogbone2, start2 = geometry
+  return (end1,
+          (svg.path.Line(end1, dogbone1),
+           svg.path.Line(dogbone1, dogbone2),
+           svg.path.Line(dogbone2, start2)),
+          start2)
+
+
+# Computing corners and dogbones a path at a time.  If numpy is
+# available and a path has at least VECTORIZE_THRESHOLD lines these use
+# numpy array operations rather than looking at one corner at a time.
+
+VECTORIZE_THRESHOLD = 64
+
+def complexArray(values):
+  return numpy.fromiter(values, dtype=complex)
+
+def complexParts(x, y):
+  '''complexParts returns the complex array with real parts x and
+  imaginary parts y.'''
+  a = numpy.empty(x.shape, dtype=complex)
+  a.real = x
+  a.imag = y
+  return a
+
+# These use the same arithmetic in the same order as unitVector and
+# dotProduct, rather than numpy.abs and complex multiplication, which
+# round differently, so that the results are exactly the same as
+# those of Corner.dogbone_geometry.
+
+def unitVectors(a):
+  x = a.real
+  y = a.imag
+  length = numpy.sqrt(x * x + y * y)
+  return complexParts(x / length, y / length)
+
+def dotProducts(a, b):
+  return a.real * b.real + a.imag * b.imag
+
+def find_corners(lines):
+  '''find_corners returns a (point, line, line) tuple for each point
+  that is an endpoint of exactly two of lines, in the order in which
+  the points first appear.'''
+  if len(lines) < VECTORIZE_THRESHOLD or not load_numpy():
+    # Index each Line by its two endpoints.  line_index maps an
+    # endpoint to the Lines that have that endpoint.
+    line_index = defaultdict(list)
+    for line in lines:
+      line_index[line.start].append(line)
+      line_index[line.end].append(line)
+    return [(point, l[0], l[1]) for point, l in line_index.items() if len(l) == 2]
+  # Endpoint 2 * i is the start of lines[i] and 2 * i + 1 its end.
+  ends = numpy.empty(2 * len(lines), dtype=complex)
+  ends[0::2] = complexArray(line.start for line in lines)
+  ends[1::2] = complexArray(line.end for line in lines)
+  points, which, counts = numpy.unique(ends, return_inverse=True,
+                                       return_counts=True)
+  # by_point lists the endpoints grouped by point, each group starting
+  # at group_start and in the order the endpoints appear.
+  by_point = numpy.argsort(which, kind='stable')
+  group_start = numpy.cumsum(counts) - counts
+  pairs = numpy.flatnonzero(counts == 2)
+  first = by_point[group_start[pairs]]
+  second = by_point[group_start[pairs] + 1]
+  order = numpy.argsort(first, kind='stable')
+  return [(complex(points[p]), lines[i // 2], lines[j // 2])
+          for p, i, j in zip(pairs[order].tolist(), first[order].tolist(),
+                             second[order].tolist())]
+
+def computeDirectionDots(corners):
+  '''computeDirectionDots fills in the direction dots of many corners
+  at once.'''
+  if len(corners) < VECTORIZE_THRESHOLD or not load_numpy():
+    return
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    l1 = unitVectors(complexArray(c.line1.start - c.line1.end for c in corners))
+    l2 = unitVectors(complexArray(c.line2.end - c.line2.start for c in corners))
+    l45 = unitVectors(l1 + l2)
+  good = numpy.isfinite(l45).tolist()
+  for corner, ok, dots in zip(corners, good, zip((-l1).tolist(), (-l45).tolist(),
+                                                 (-l2).tolist())):
+    # Degenerate corners are left to Corner.computeDirectionDots.
+    if ok:
+      corner.direction_dots = dots
+
+def dogboneGeometries(corners, config=DEFAULT_CONFIG):
+  '''dogboneGeometries returns the dogbone_geometry of each of
+  corners, all of which have the DogboneConfig config.'''
+  if len(corners) < VECTORIZE_THRESHOLD or not load_numpy():
+    return [corner.dogbone_geometry() for corner in corners]
+  result = [None] * len(corners)
+  chosen = [i for i, c in enumerate(corners) if c.dogbone_direction is not None]
+  if not chosen:
+    return result
+  # This follows Corner.dogbone_geometry.
+  picked = [corners[i] for i in chosen]
+  direction = complexArray(c.dogbone_direction for c in picked)
+  start1 = complexArray(c.line1.start for c in picked)
+  end1 = complexArray(c.line1.end for c in picked)
+  start2 = complexArray(c.line2.start for c in picked)
+  end2 = complexArray(c.line2.end for c in picked)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    vector1 = unitVectors(end1 - start1)
+    vector2 = unitVectors(end2 - start2)
+    length = (config.cutter_diameter * 0.5 + config.extra) * direction
+    # perpendicular is multiplication by i.
+    width = (config.cutter_diameter + config.dogbone_base) * 1j * direction
+    width = numpy.where(dotProducts(width, unitVectors(vector1 + vector2)) < 0,
+                        -width, width)
+    end1 = end1 - vector1 * dotProducts(vector1, width)
+    start2 = start2 + vector2 * dotProducts(vector2, width)
+  good = numpy.isfinite(end1) & numpy.isfinite(start2)
+  geometries = zip(end1.tolist(), (end1 + length).tolist(),
+                   (start2 + length).tolist(), start2.tolist())
+  for i, ok, geometry in zip(chosen, good.tolist(), geometries):
+    # Degenerate corners get the scalar treatment, errors and all.
+    result[i] = geometry if ok else corners[i].dogbone_geometry()
+  return result
+
+def dogboneSegments(corners, config=DEFAULT_CONFIG):
+  '''dogboneSegments returns the dogbone_segments of each of
+  corners, all of which have the DogboneConfig config.'''
+  if config.style == 'arc':
+    return [corner.dogbone_segments() for corner in corners]
+  return [rectangleSegments(g) for g in dogboneGeometries(corners, config)]
+
+
+# Dogbone rules choose the dogbone direction for a Corner without user
+# interaction.  A rule is a function of a Corner that returns one of
+# the unit vectors from Corner.directionDots, or None for no dogbone.
+
+DOGBONE_RULES = {}
+
+def dogbone_rule(name):
+  def defineRule(f):
+    DOGBONE_RULES[name] = f
+    return f
+  return defineRule
+
+@dogbone_rule('none')
+def noDogboneRule(corner):
+  return None
+
+@dogbone_rule('bisector')
+def bisectorRule(corner):
+  return corner.directionDots()[1]
+
+@dogbone_rule('first_leg')
+def firstLegRule(corner):
+  return corner.directionDots()[0]
+
+@dogbone_rule('second_leg')
+def secondLegRule(corner):
+  return corner.directionDots()[2]
+
+
+def class_rule(arg):
+  '''class_rule parses a CLASS=RULE command line argument.'''
+  cls, sep, rule = arg.partition('=')
+  if not sep or not cls:
+    raise ValueError('Expected CLASS=RULE, got %r' % arg)
+  check_rule_name(rule)
+  return (cls, rule)
+
+def element_rule(elt, default_rule, class_rules={}):
+  '''element_rule returns the name of the rule for the SVG element elt:
+  that of the first of its classes in class_rules, otherwise
+  default_rule.'''
+  for cls in elt.getAttribute("class").split():
+    if cls in class_rules:
+      return class_rules[cls]
+  return default_rule
+
+def check_rule_name(rule):
+  if not rule in DOGBONE_RULES:
+    raise ValueError('Unknown rule %r, expected one of %s' %
+                     (rule, ', '.join(sorted(DOGBONE_RULES))))
+
+
+# Transforms
+
+# An affine transform is a tuple (a, b, c, d, e, f) of the arguments of
+# the SVG matrix() transform function.  It maps x, y to
+# a * x + c * y + e, b * x + d * y + f.
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+TRANSFORM_RE = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+
+NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def compose(m1, m2):
+  '''compose returns the transform that applies m2 and then m1.'''
+  a1, b1, c1, d1, e1, f1 = m1
+  a2, b2, c2, d2, e2, f2 = m2
+  return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+          a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+          a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+def invert(m):
+  a, b, c, d, e, f = m
+  det = a * d - b * c
+  return (d / det, -b / det, -c / det, a / det,
+          (c * f - d * e) / det, (b * e - a * f) / det)
+
+def apply_transform(m, cplx):
+  a, b, c, d, e, f = m
+  x = pointX(cplx)
+  y = pointY(cplx)
+  return cplxPoint(a * x + c * y + e, b * x + d * y + f)
+
+def parse_transform(text):
+  '''parse_transform returns the transform described by the value of
+  an SVG transform attribute.'''
+  m = IDENTITY
+  for name, args in TRANSFORM_RE.findall(text):
+    v = [float(n) for n in NUMBER_RE.findall(args)]
+    if not v:
+      raise ValueError('Bad transform %r' % text)
+    if name == 'matrix':
+      if len(v) != 6:
+        raise ValueError('Bad transform %r' % text)
+      t = tuple(v)
+    elif name == 'translate':
+      t = (1.0, 0.0, 0.0, 1.0, v[0], v[1] if len(v) > 1 else 0.0)
+    elif name == 'scale':
+      t = (v[0], 0.0, 0.0, v[1] if len(v) > 1 else v[0], 0.0, 0.0)
+    elif name == 'rotate':
+      angle = math.radians(v[0])
+      cos = math.cos(angle)
+      sin = math.sin(angle)
+      t = (cos, sin, -sin, cos, 0.0, 0.0)
+      if len(v) == 3:
+        # Rotate about v[1], v[2] rather than the origin.
+        t = compose((1.0, 0.0, 0.0, 1.0, v[1], v[2]),
+                    compose(t, (1.0, 0.0, 0.0, 1.0, -v[1], -v[2])))
+    elif name == 'skewX':
+      t = (1.0, 0.0, math.tan(math.radians(v[0])), 1.0, 0.0, 0.0)
+    else:
+      t = (1.0, math.tan(math.radians(v[0])), 0.0, 1.0, 0.0, 0.0)
+    m = compose(m, t)
+  return m
+
+def element_transform(parent_transform, elt):
+  '''element_transform returns the transform from the coordinates of
+  the element elt to those of the document, given that of its
+  parent.'''
+  if not elt.hasAttribute("transform"):
+    return parent_transform
+  return compose(parent_transform, parse_transform(elt.getAttribute("transform")))
+
+def transform_segment(m, step):
+  '''transform_segment returns a copy of the path segment step
+  transformed by m.'''
+  if isinstance(step, svg.path.Move):
+    return svg.path.Move(apply_transform(m, step.start), step.relative)
+  if isinstance(step, svg.path.Close):
+    return svg.path.Close(apply_transform(m, step.start),
+                          apply_transform(m, step.end), step.relative)
+  if isinstance(step, svg.path.Line):
+    return svg.path.Line(apply_transform(m, step.start),
+                         apply_transform(m, step.end), step.relative)
+  if isinstance(step, svg.path.CubicBezier):
+    return svg.path.CubicBezier(*[apply_transform(m, p) for p in (
+      step.start, step.control1, step.control2, step.end)],
+                                relative=step.relative)
+  if isinstance(step, svg.path.QuadraticBezier):
+    return svg.path.QuadraticBezier(*[apply_transform(m, p) for p in (
+      step.start, step.control, step.end)], relative=step.relative)
+  if isinstance(step, svg.path.Arc):
+    # The axes of the transformed ellipse are found from the
+    # eigenvectors of E E^T, where E maps the unit circle to the
+    # transformed ellipse.
+    a, b, c, d = m[:4]
+    rotation = math.radians(step.rotation)
+    rx = pointX(step.radius) * cplxPoint(math.cos(rotation), math.sin(rotation))
+    ry = pointY(step.radius) * cplxPoint(-math.sin(rotation), math.cos(rotation))
+    p, r = a * pointX(rx) + c * pointY(rx), b * pointX(rx) + d * pointY(rx)
+    q, s = a * pointX(ry) + c * pointY(ry), b * pointX(ry) + d * pointY(ry)
+    eA = p * p + q * q
+    eB = p * r + q * s
+    eC = r * r + s * s
+    mean = (eA + eC) / 2
+    spread = math.hypot((eA - eC) / 2, eB)
+    return svg.path.Arc(apply_transform(m, step.start),
+                        cplxPoint(math.sqrt(mean + spread),
+                                  math.sqrt(max(mean - spread, 0.0))),
+                        math.degrees(0.5 * math.atan2(2 * eB, eA - eC)),
+                        step.arc,
+                        # A reflection reverses the direction of sweep.
+                        step.sweep != (a * d - b * c < 0),
+                        apply_transform(m, step.end), step.relative)
+  raise ValueError('Unsupported path segment %r' % step)
+
+def transform_path(m, path):
+  '''transform_path returns a copy of path transformed by m.'''
+  return svg.path.Path(*[transform_segment(m, step) for step in path])
+
+# Paths are written with their coordinates rounded to OUTPUT_DECIMALS
+# places, so that the rounding error from transforming them and adding
+# dogbones doesn't show up as coordinates like -5.55112E-17.
+OUTPUT_DECIMALS = 4
+
+def round_float(f):
+  # Adding 0.0 turns -0.0 into 0.0.
+  return round(f, OUTPUT_DECIMALS) + 0.0
+
+def round_point(cmplx):
+  return cplxPoint(round_float(pointX(cmplx)), round_float(pointY(cmplx)))
+
+def round_segment(step):
+  '''round_segment returns a copy of the path segment step with its
+  coordinates rounded to OUTPUT_DECIMALS places.'''
+  if isinstance(step, svg.path.Move):
+    return svg.path.Move(round_point(step.start), step.relative)
+  if isinstance(step, svg.path.Close):
+    return svg.path.Close(round_point(step.start), round_point(step.end),
+                          step.relative)
+  if isinstance(step, svg.path.Line):
+    return svg.path.Line(round_point(step.start), round_point(step.end),
+                         step.relative)
+  if isinstance(step, svg.path.CubicBezier):
+    return svg.path.CubicBezier(*[round_point(p) for p in (
+      step.start, step.control1, step.control2, step.end)],
+                                relative=step.relative)
+  if isinstance(step, svg.path.QuadraticBezier):
+    return svg.path.QuadraticBezier(*[round_point(p) for p in (
+      step.start, step.control, step.end)], relative=step.relative)
+  if isinstance(step, svg.path.Arc):
+    return svg.path.Arc(round_point(step.start), round_point(step.radius),
+                        round_float(step.rotation), step.arc, step.sweep,
+                        round_point(step.end), step.relative)
+  raise ValueError('Unsupported path segment %r' % step)
+
+def round_path(path):
+  '''round_path returns a copy of path with its coordinates rounded to
+  OUTPUT_DECIMALS places.'''
+  return svg.path.Path(*[round_segment(step) for step in path])
+
+
+# Shapes
+
+# Besides path elements we add dogbones to these basic shapes, which
+# are first converted to paths.  SHAPE_GEOMETRY maps each of them to
+# the attributes that describe its geometry.  Those attributes are
+# replaced by d when a shape is converted.
+SHAPE_GEOMETRY = {
+  "path": ("d",),
+  "rect": ("x", "y", "width", "height", "rx", "ry"),
+  "polygon": ("points",),
+  "polyline": ("points",),
+}
+
+def length_attribute(elt, name):
+  # Lengths with units are taken to be in user units.
+  m = NUMBER_RE.match(elt.getAttribute(name).strip())
+  return float(m.group(0)) if m else 0.0
+
+def points_d(points, closed):
+  if not points:
+    return ""
+  if closed:
+    # An explicit Line back to the start, rather than just Z, so that the
+    # starting point is a corner too.
+    points = points + [points[0]]
+  return ("M %s " % points[0] +
+          " ".join("L %s" % p for p in points[1:]) +
+          (" Z" if closed else ""))
+
+def shape_d(elt):
+  '''shape_d returns the d attribute of a path equivalent to the shape
+  element elt, or None if elt can't have corners that need dogbones.'''
+  tag = elt.tagName
+  if tag == "path":
+    return elt.getAttribute("d") if elt.hasAttribute("d") else None
+  if tag == "rect":
+    if length_attribute(elt, "rx") > 0 or length_attribute(elt, "ry") > 0:
+      # Rounded corners don't need dogbones.
+      return None
+    x = length_attribute(elt, "x")
+    y = length_attribute(elt, "y")
+    width = length_attribute(elt, "width")
+    height = length_attribute(elt, "height")
+    if width <= 0 or height <= 0:
+      return None
+    return points_d(["%r,%r" % p for p in ((x, y), (x + width, y),
+                                            (x + width, y + height),
+                                            (x, y + height))], True)
+  if tag in ("polygon", "polyline"):
+    coordinates = NUMBER_RE.findall(elt.getAttribute("points"))
+    points = ["%s,%s" % xy for xy in zip(coordinates[0::2], coordinates[1::2])]
+    if len(points) < 2:
+      return None
+    return points_d(points, tag == "polygon")
+  return None
+
+def shape_key(elt, transform):
+  '''shape_key returns a key that is the same for shape elements that
+  have the same geometry and transform.'''
+  return ((elt.tagName, transform) +
+          tuple(elt.getAttribute(a) for a in SHAPE_GEOMETRY[elt.tagName]))
+
+def shape_to_path(elt, d):
+  '''shape_to_path replaces the shape element elt in its document
+  with an equivalent path element having the path data d, and returns
+  the path element.'''
+  path = elt.ownerDocument.createElement("path")
+  for name, value in elt.attributes.items():
+    if not name in SHAPE_GEOMETRY[elt.tagName]:
+      path.setAttribute(name, value)
+  path.setAttribute("d", d)
+  while elt.firstChild:
+    path.appendChild(elt.firstChild)
+  if elt.parentNode:
+    elt.parentNode.replaceChild(path, elt)
+  return path
+
+
+# The attribute in which Shaper Origin SVG files record the cut type
+# of a path.
+CUT_TYPE_ATTRIBUTE = "shaper:cutType"
+
+# Which side of a closed path the cutter is on for each cut type, or
+# None for the cut types that follow the path itself, which never get
+# dogbones.  Paths with no cut type are offered every corner, and
+# those with a cut type not listed here none.
+CUT_TYPE_SIDES = {
+  "inside": "inside",
+  "pocket": "inside",
+  "outside": "outside",
+  "online": None,
+  "guide": None,
+}
+
+def subpathAreas(path):
+  '''subpathAreas maps the id of each segment of path to the signed
+  area of the closed subpath it is part of, or 0 if that subpath is
+  open.  Curves are treated as straight lines for this.'''
+  areas = {}
+  def finish(segments, start, end, area):
+    closed = segments and start == end
+    for segment in segments:
+      areas[id(segment)] = area / 2 if closed else 0
+  segments = []
+  start = end = None
+  area = 0.0
+  for step in path:
+    if isinstance(step, svg.path.Move):
+      finish(segments, start, end, area)
+      segments = []
+      start = end = step.end
+      area = 0.0
+      continue
+    if start is None:
+      start = step.start
+    segments.append(step)
+    # The shoelace formula.
+    area += (pointX(step.start) * pointY(step.end) -
+             pointX(step.end) * pointY(step.start))
+    end = step.end
+  finish(segments, start, end, area)
+  return areas
 
 
 class PathHolder (object):
-  '''One PathHolder is created for each SVG path element.'''
-  def __init__(self, path_elt):
+  '''One PathHolder is created for each SVG path element or basic
+  shape.  transform maps the element's coordinates to those of the
+  document.  The path is held, and dogbones are sized, in document
+  coordinates.  config is the DogboneConfig to use.'''
+  def __init__(self, path_elt, transform=IDENTITY, config=DEFAULT_CONFIG):
     assert path_elt.nodeType == xml.dom.Node.ELEMENT_NODE
-    assert path_elt.tagName == "path"
+    assert path_elt.tagName in SHAPE_GEOMETRY
     self.path_elt = path_elt
-    self.parsed_path = svg.path.parse_path(self.path_elt.getAttribute("d"))
-    cleanupPath(self.parsed_path)
-    # Index each Line by its two endpoints.  line_index maps an endpoint
-    # to the Lines that hvae that endpoint.
-    line_index = defaultdict(list)
-    for step in self.parsed_path:
-      if isinstance(step, svg.path.path.Line):
-        line_index[step.start].append(step)
-        line_index[step.end].append(step)
-    self.corners = []    # list of Corner objects
-    for point, lines in line_index.items():
-      if len(lines) == 2:
-        self.corners.append(Corner(self, point, lines[0], lines[1]))
+    self.transform = transform
+    self.config = config
+    with instrument.stage("parse_path"):
+      self.parsed_path = svg.path.parse_path(shape_d(self.path_elt) or "")
+      if transform != IDENTITY:
+        self.parsed_path = transform_path(transform, self.parsed_path)
+    # The number of dogbones added by make_dogbones.
+    self.dogbone_count = 0
+    with instrument.stage("cleanup"):
+      self.cleanup_stats = cleanupPath(self.parsed_path, config)
+    with instrument.stage("corners"):
+      lines = [step for step in self.parsed_path
+               if isinstance(step, svg.path.path.Line)]
+      corners = [Corner(self, point, line1, line2, config)
+                 for point, line1, line2 in find_corners(lines)]
+      # Only offer dogbones at internal corners: those that the cutter
+      # can't get all the way into.
+      areas = subpathAreas(self.parsed_path)
+      cut_type = (self.path_elt.getAttribute(CUT_TYPE_ATTRIBUTE) or
+                  config.default_cut_type)
+      self.corners = [c for c in corners if c.isInternal(areas, cut_type)]
+    # How many corners were left out.
+    self.external_corner_count = len(corners) - len(self.corners)
+    instrument.count("paths")
+    instrument.count("segments", len(self.parsed_path))
+    instrument.count("corners", len(self.corners))
 
   def __str__(self):
     return "%s(%s)" % (self.__class__.__name__, str(self.parsed_path))
 
-  def render(self, gui):
-    # draw the lines of the path.  We don't yet support curves, circles,
-    # rectangles, etc, only lines.
-    for step in self.parsed_path:
-      if isinstance(step, svg.path.path.Line):
-        gui.line(pointX(step.start), pointY(step.start),
-                 pointX(step.end), pointY(step.end))
-    # Draw the dogbone direction selector dots
-    for corner in self.corners:
-      for uv in corner.directionDots():
-        selected = corner.dogbone_direction == uv
-        dot = corner.dotLocation(uv)
-        gui.dot(pointX(dot), pointY(dot), selected)
+  def classes(self):
+    '''classes returns the SVG class names of the path element.'''
+    return self.path_elt.getAttribute("class").split()
+
+  def d(self):
+    '''d returns the path data of the path in the coordinates of its
+    element.'''
+    if self.transform == IDENTITY:
+      return round_path(self.parsed_path).d()
+    return round_path(transform_path(invert(self.transform),
+                                     self.parsed_path)).d()
 
   def update(self):
-    self.path_elt.setAttribute("d", self.parsed_path.d())
+    if self.path_elt.tagName == "path":
+      self.path_elt.setAttribute("d", self.d())
+    elif self.dogbone_count:
+      # Shapes are only converted to paths if they've changed.
+      self.path_elt = shape_to_path(self.path_elt, self.d())
+
+  def choose_dogbones(self, default_rule, class_rules={}):
+    '''See PathCollector.choose_dogbones.'''
+    choose = DOGBONE_RULES[element_rule(self.path_elt, default_rule, class_rules)]
+    with instrument.stage("choose_dogbones"):
+      computeDirectionDots(self.corners)
+      for corner in self.corners:
+        corner.dogbone_direction = choose(corner)
+
+  def make_dogbones(self):
+    '''make_dogbones adds the chosen dogbones to the path and returns
+    how many there were.'''
+    with instrument.stage("make_dogbones"):
+      added = self.add_dogbones()
+    instrument.count("dogbones", added)
+    return added
+
+  def add_dogbones(self):
+    # Rather than inserting each dogbone into parsed_path, which would
+    # take time proportional to the length of the path for each one, we
+    # note what follows each line1 and build the new path in one pass.
+    # Lines aren't hashable, so they are identified by id.
+    dogbones = {}
+    new_starts = {}
+    for corner, dogbone in zip(self.corners,
+                               dogboneSegments(self.corners, self.config)):
+      if dogbone is None:
+        continue
+      end1, segments, start2 = dogbone
+      corner.line1.end = end1
+      corner.line2.start = start2
+      # The legs have changed.
+      corner.direction_dots = None
+      corner.dot_locations = None
+      dogbones[id(corner.line1)] = segments
+      new_starts[id(corner.line2)] = start2
+    if dogbones:
+      segments = []
+      for i, step in enumerate(self.parsed_path):
+        if isinstance(step, svg.path.Move) and i + 1 < len(self.parsed_path):
+          # If the next line begins a subpath, this Move must follow it.
+          start = new_starts.get(id(self.parsed_path[i + 1]))
+          if start is not None:
+            step.start = step.end = start
+        segments.append(step)
+        segments.extend(dogbones.get(id(step), ()))
+      self.parsed_path[:] = segments
+    self.dogbone_count += len(dogbones)
+    return len(dogbones)
 
 
 class PathCollector (object):
-  '''PathCollector finds all of the paths in an SVG document.'''
-  def __init__(self):
+  '''PathCollector finds all of the paths and basic shapes in an SVG
+  document, taking account of the transforms of the groups that
+  contain them.  Their dogbones are made as config, a DogboneConfig,
+  says.'''
+  def __init__(self, config=DEFAULT_CONFIG):
+    self.config = config
     self.paths = []
 
   def gather(self, node):
-    if isinstance(node, xml.dom.minidom.Element):
-      if node.tagName == "path":
-        self.paths.append(PathHolder(node))
-    if isinstance(node, xml.dom.minidom.Node):
-      for child in node.childNodes:
-        self.gather(child)
+    # We keep our own stack of nodes to visit rather than recursing so
+    # that deeply nested groups can't exceed Python's recursion limit.
+    stack = [(node, IDENTITY)]
+    while stack:
+      node, transform = stack.pop()
+      if isinstance(node, xml.dom.minidom.Element):
+        transform = element_transform(transform, node)
+        if node.tagName in SHAPE_GEOMETRY and shape_d(node):
+          self.paths.append(PathHolder(node, transform, self.config))
+      if isinstance(node, xml.dom.minidom.Node):
+        # Reversed so that paths are gathered in document order.
+        stack.extend((child, transform) for child in reversed(node.childNodes))
+
+  def index(self):
+    '''index builds the spatial indexes used by the GUI.  It should be
+    called after gather.'''
+    self.corner_index = CornerIndex(self.paths)
+    self.segment_index = SegmentIndex(self.paths)
 
   def render(self, gui):
+    '''render draws those lines and corners that are in gui's
+    viewport.'''
     gui.clear()
-    for ph in self.paths:
-      ph.render(gui)
+    minX, minY, maxX, maxY = gui.viewport()
+    # draw the lines of the paths.  We don't yet support curves,
+    # circles, rectangles, etc, only lines.
+    for step in self.segment_index.within(minX, minY, maxX, maxY):
+      gui.line_items.append(
+        (step, gui.line(pointX(step.start), pointY(step.start),
+                        pointX(step.end), pointY(step.end))))
+    # Draw the dogbone direction selector dots of the corners near
+    # enough to the viewport for their dots to be visible.
+    margin = direction_dot_distance
+    for corner in self.corner_index.within(minX - margin, minY - margin,
+                                           maxX + margin, maxY + margin):
+      gui.corner(corner)
 
   def update(self):
     for ph in self.paths:
       ph.update()
 
+  def choose_dogbones(self, default_rule, class_rules={}):
+    '''choose_dogbones sets the dogbone direction of every Corner by
+    rule rather than by mouse clicks.  class_rules maps an SVG class
+    name to the name of the rule for paths of that class.  Other paths
+    use default_rule.'''
+    for ph in self.paths:
+      ph.choose_dogbones(default_rule, class_rules)
+
+
+# Distance from a corner within which a click is considered to be
+# about that corner, in SVG coordinates:
+hit_radius = direction_dot_distance * 2
+
+
+class CornerIndex (object):
+  '''CornerIndex finds the Corners near a point quickly.  Corners are
+  kept in a grid of square cells, each cell_size on a side, so only the
+  cells around a point need to be searched.'''
+  def __init__(self, paths, cell_size=hit_radius):
+    self.cell_size = cell_size
+    self.cells = defaultdict(list)
+    for ph in paths:
+      for corner in ph.corners:
+        self.cells[self.cell(corner.x, corner.y)].append(corner)
+
+  def cell(self, x, y):
+    return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+  def nearest(self, x, y, radius):
+    '''nearest returns the Corner closest to x, y that is no farther
+    than radius from it, or None.'''
+    reach = int(math.ceil(radius / self.cell_size))
+    cx, cy = self.cell(x, y)
+    closest = None
+    for i in range(cx - reach, cx + reach + 1):
+      for j in range(cy - reach, cy + reach + 1):
+        for corner in self.cells.get((i, j), ()):
+          d = corner.distance(x, y)
+          if d <= radius and (closest is None or d < closest[0]):
+            closest = (d, corner)
+    if closest is None:
+      return None
+    return closest[1]
+
+  def within(self, minX, minY, maxX, maxY):
+    '''within returns the Corners inside the given rectangle.'''
+    result = []
+    cx0, cy0 = self.cell(minX, minY)
+    cx1, cy1 = self.cell(maxX, maxY)
+    for key, corners in cells_in(self.cells, cx0, cy0, cx1, cy1):
+      for corner in corners:
+        if minX <= corner.x <= maxX and minY <= corner.y <= maxY:
+          result.append(corner)
+    return result
+
+
+def cells_in(cells, cx0, cy0, cx1, cy1):
+  '''cells_in yields the (key, contents) of the cells of the grid
+  dict cells from cx0, cy0 to cx1, cy1 inclusive.'''
+  if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+    # It's quicker to look at every occupied cell.
+    for (i, j), contents in cells.items():
+      if cx0 <= i <= cx1 and cy0 <= j <= cy1:
+        yield (i, j), contents
+  else:
+    for i in range(cx0, cx1 + 1):
+      for j in range(cy0, cy1 + 1):
+        contents = cells.get((i, j))
+        if contents:
+          yield (i, j), contents
+
+
+class SegmentIndex (object):
+  '''SegmentIndex finds the Lines of the paths that might be inside a
+  rectangle.  Each Line is listed in every grid cell that its bounding
+  box overlaps.'''
+  def __init__(self, paths, cells_across=64):
+    self.lines = []
+    for ph in paths:
+      for step in ph.parsed_path:
+        if isinstance(step, svg.path.path.Line):
+          self.lines.append(step)
+    if self.lines:
+      xs = [pointX(p) for l in self.lines for p in (l.start, l.end)]
+      ys = [pointY(p) for l in self.lines for p in (l.start, l.end)]
+      self.bbox = (min(xs), min(ys), max(xs), max(ys))
+    else:
+      self.bbox = (0.0, 0.0, 1.0, 1.0)
+    minX, minY, maxX, maxY = self.bbox
+    self.cell_size = max(maxX - minX, maxY - minY, 1e-6) / cells_across
+    self.cells = defaultdict(list)
+    for line in self.lines:
+      cx0, cy0, cx1, cy1 = self.lineCells(line)
+      for i in range(cx0, cx1 + 1):
+        for j in range(cy0, cy1 + 1):
+          self.cells[(i, j)].append(line)
+
+  def cell(self, x, y):
+    return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+  def lineCells(self, line):
+    cx0, cy0 = self.cell(min(pointX(line.start), pointX(line.end)),
+                         min(pointY(line.start), pointY(line.end)))
+    cx1, cy1 = self.cell(max(pointX(line.start), pointX(line.end)),
+                         max(pointY(line.start), pointY(line.end)))
+    return cx0, cy0, cx1, cy1
+
+  def within(self, minX, minY, maxX, maxY):
+    '''within returns the Lines whose bounding boxes overlap the given
+    rectangle.'''
+    seen = set()
+    result = []
+    cx0, cy0 = self.cell(minX, minY)
+    cx1, cy1 = self.cell(maxX, maxY)
+    for key, lines in cells_in(self.cells, cx0, cy0, cx1, cy1):
+      for line in lines:
+        # svg.path Lines aren't hashable.
+        if id(line) in seen:
+          continue
+        seen.add(id(line))
+        if (max(pointX(line.start), pointX(line.end)) >= minX and
+            min(pointX(line.start), pointX(line.end)) <= maxX and
+            max(pointY(line.start), pointY(line.end)) >= minY and
+            min(pointY(line.start), pointY(line.end)) <= maxY):
+          result.append(line)
+    return result
+
 
 def canvasButtonDownHandler(event):
   '''canvasButtonHandler is the mouse down event handler for the canvas.'''
-  # distance from corner for consideration
-  hit_radius = direction_dot_distance * 2
   # distance from dot for consideration
   dot_event_horizon = dot_size / transformer.scale
   app = event.widget.application
   x, y = transformer.toSVG(event.x, event.y)
-  closest = None     # The Corner closest to the mouse click.
-  for pc in app.path_collector.paths:
-    for corner in pc.corners:
-      d = corner.distance(x, y)
-      if d <= hit_radius:
-        if closest is None:
-          closest = (d, corner)
-        elif d < closest[0]:
-          closest = (d, corner)
-  if not (closest is None):
-    corner = closest[1]
-    dots = corner.directionDots()
+  # The Corner closest to the mouse click.
+  corner = app.path_collector.corner_index.nearest(x, y, hit_radius)
+  if not (corner is None):
     hit = cplxPoint(x, y)
     chosen = None
-    for uv in dots:
-      d = distance(corner.dotLocation(uv), hit)
+    for uv, location in corner.dotLocations():
+      d = distance(location, hit)
       if d <= dot_event_horizon:
         if chosen is None or d < chosen[0]:
           chosen = (d, uv)
     if chosen:
       corner.dogbone_direction = chosen[1]
-      event.widget.application.redraw()
     else:
       corner.dogbone_direction = None
-      event.widget.application.redraw()
+    app.cornerChanged(corner)
 
 
 class GUI (object):
@@ -323,81 +1388,715 @@ class GUI (object):
   def __init__(self, pathCollector):
     assert isinstance(pathCollector, PathCollector)
     self.path_collector = pathCollector
+    self.path_collector.index()
+    # tkinter is only imported when it's needed so that batch mode works
+    # without it and starts quickly.
+    import tkinter
+    global transformer
+    transformer = Transformer()
     self.root = tkinter.Tk()
     frame = tkinter.Frame(self.root,
         width=1000,
         height=600,
         background="#000000",
         borderwidth=2)
-    frame.pack(fill=tkinter.BOTH)
-    self.canvas = tkinter.Canvas(frame)
-    self.canvas.pack(fill=tkinter.BOTH)
+    frame.pack(fill=tkinter.BOTH, expand=True)
+    self.canvas = tkinter.Canvas(frame, width=1000, height=600)
+    self.canvas.pack(fill=tkinter.BOTH, expand=True)
     self.canvas.application = self
     self.canvas.bind("<Button-1>", canvasButtonDownHandler)
+    # Zooming: the mouse wheel (Button-4 and Button-5 on X11) or + and -.
+    self.canvas.bind("<MouseWheel>",
+                     lambda e: self.zoom(1.1 ** (e.delta / 120.0), e.x, e.y))
+    self.canvas.bind("<Button-4>", lambda e: self.zoom(1.1, e.x, e.y))
+    self.canvas.bind("<Button-5>", lambda e: self.zoom(1 / 1.1, e.x, e.y))
+    self.root.bind("<plus>", lambda e: self.zoom(1.25))
+    self.root.bind("<equal>", lambda e: self.zoom(1.25))
+    self.root.bind("<minus>", lambda e: self.zoom(0.8))
+    # Panning: drag with the right or middle mouse button.
+    for button in (2, 3):
+      self.canvas.bind("<ButtonPress-%d>" % button, self.startPan)
+      self.canvas.bind("<B%d-Motion>" % button, self.panTo)
+      self.canvas.bind("<ButtonRelease-%d>" % button, lambda e: self.redraw())
+    # f fits the whole design to the window.
+    self.root.bind("<f>", lambda e: self.fit())
+    self.canvas.bind("<Configure>", lambda e: self.redraw())
 #    self.canvas.bind("<ButtonRelease-1>", canvasButtonUpHandler)
 #    self.active_corner = None
 
   def redraw(self):
+    '''redraw draws everything again from scratch.'''
     self.path_collector.render(self)
 
   def clear(self):
     self.canvas.delete("all")
-
-  def line(self, fromX, fromY, toX, toY):
+    # Canvas item ids of what we've drawn.  line_items is a list of
+    # (svg.path.Line, item) pairs.  dot_items maps a Corner to a list
+    # of (unit vector, item) pairs for its direction dots and
+    # preview_items maps a Corner to the items previewing its dogbone.
+    self.line_items = []
+    self.dot_items = {}
+    self.preview_items = {}
+
+  def line(self, fromX, fromY, toX, toY, color="#ffffff"):
     # eventually apply scaling here
     x1, y1 = transformer.toCanvas(fromX, fromY)
     x2, y2 = transformer.toCanvas(toX, toY)
-    self.canvas.create_line(x1, y1, x2, y2, fill="#ffffff")
+    return self.canvas.create_line(x1, y1, x2, y2, fill=color)
 
   def dot(self, x, y, selected):
     x1, y1 = transformer.toCanvas(x, y)
     x2, y2 = transformer.toCanvas(x, y)
-    self.canvas.create_oval(x1 - dot_size, y1 - dot_size,
-                            x2 + dot_size, y2 + dot_size,
-                            fill=(
-                              "yellow" if selected
-                              else "blue"))
+    return self.canvas.create_oval(x1 - dot_size, y1 - dot_size,
+                                   x2 + dot_size, y2 + dot_size,
+                                   fill=self.dotColor(selected))
+
+  def dotColor(self, selected):
+    return "yellow" if selected else "blue"
+
+  def corner(self, corner):
+    '''corner draws the direction dots of corner and a preview of its
+    dogbone, remembering their canvas items.'''
+    self.dot_items[corner] = [
+      (uv, self.dot(pointX(dot), pointY(dot), corner.dogbone_direction == uv))
+      for uv, dot in corner.dotLocations()]
+    self.preview(corner)
+
+  def preview(self, corner):
+    items = []
+    dogbone = corner.dogbone_segments()
+    if dogbone:
+      for segment in dogbone[1]:
+        # Curves are drawn as a series of short lines.
+        steps = 1 if isinstance(segment, svg.path.Line) else 16
+        points = [segment.point(i / steps) for i in range(steps + 1)]
+        for start, end in zip(points, points[1:]):
+          items.append(self.line(pointX(start), pointY(start),
+                                 pointX(end), pointY(end),
+                                 color="orange"))
+    self.preview_items[corner] = items
+
+  def cornerChanged(self, corner):
+    '''cornerChanged updates the drawing of corner after its dogbone
+    direction has changed, leaving everything else alone.'''
+    for uv, item in self.dot_items.get(corner, []):
+      self.canvas.itemconfigure(
+        item, fill=self.dotColor(corner.dogbone_direction == uv))
+    for item in self.preview_items.get(corner, []):
+      self.canvas.delete(item)
+    self.preview(corner)
+
+  def viewport(self):
+    '''viewport returns the SVG coordinates (minX, minY, maxX, maxY)
+    of the visible part of the canvas.'''
+    minX, minY = transformer.toSVG(0, 0)
+    maxX, maxY = transformer.toSVG(self.canvas.winfo_width(),
+                                   self.canvas.winfo_height())
+    return minX, minY, maxX, maxY
+
+  def zoom(self, factor, x=None, y=None):
+    '''zoom scales the drawing by factor around canvas point x, y,
+    by default the middle of the canvas.'''
+    if x is None:
+      x = self.canvas.winfo_width() / 2
+      y = self.canvas.winfo_height() / 2
+    transformer.zoom(factor, x, y)
+    self.redraw()
+
+  def startPan(self, event):
+    self.pan_from = (event.x, event.y)
+
+  def panTo(self, event):
+    # While dragging we just move what's already drawn.  What has come
+    # into view is drawn when the button is released.
+    dx = event.x - self.pan_from[0]
+    dy = event.y - self.pan_from[1]
+    transformer.pan(dx, dy)
+    self.canvas.move("all", dx, dy)
+    self.pan_from = (event.x, event.y)
+
+  def fit(self):
+    '''fit scales and positions the drawing to fill the window.'''
+    self.canvas.update_idletasks()
+    transformer.fit(self.path_collector.segment_index.bbox,
+                    self.canvas.winfo_width(), self.canvas.winfo_height())
+    self.redraw()
 
   def show(self):
-    self.path_collector.render(self)
+    self.fit()
 
   def run(self):
     self.root.mainloop()
 
 
+# Streaming
+
+# For batch mode we don't need the whole document in memory.  The
+# input is read a piece at a time and copied to the output as is,
+# except that the d attribute of each path element that gets dogbones
+# is rewritten and basic shapes that get dogbones become paths.  Only
+# start tags are parsed, into minidom Elements of STREAM_DOCUMENT so
+# that PathHolder can work with them.
+
+STREAM_DOCUMENT = xml.dom.minidom.Document()
+
+# Matches a start tag or empty element tag, allowing for ">" inside
+# quoted attribute values.
+TAG_RE = re.compile(r'''<([^\s/>!?]+)(?:[^>"']|"[^"]*"|'[^']*')*>''')
+
+# Matches an attribute in a tag.  The value is in group 3 or 4.
+ATTRIBUTE_RE = re.compile(r'''\s([^\s=]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+# Constructs that may contain text that looks like a tag, and the text
+# that ends each of them.
+SKIPPED = (('<!--', '-->'), ('<![CDATA[', ']]>'), ('<?', '?>'))
+
+
+# Matches the characters that decide where a tag ends.
+TAG_END_RE = re.compile(r'''[>"']''')
+
+def tag_end(buf, pos, quote):
+  '''tag_end looks for the > that ends the tag at the start of buf,
+  starting at pos, where quote is the quote character of the attribute
+  value pos is in, if any.  It returns the index just past the >, or -1
+  if buf doesn't have it yet, and the pos and quote to carry on from
+  once more of the tag has been read.'''
+  while True:
+    if quote:
+      close = buf.find(quote, pos)
+      if close < 0:
+        return -1, len(buf), quote
+      pos = close + 1
+      quote = None
+    else:
+      m = TAG_END_RE.search(buf, pos)
+      if m is None:
+        return -1, len(buf), None
+      if m.group() == '>':
+        return m.end(), m.end(), None
+      pos = m.end()
+      quote = m.group()
+
+
+def svg_tokens(reader, chunk_size=1 << 16):
+  '''svg_tokens splits the text read from reader into a sequence of
+  (tag name, text) pairs.  tag name is the name of the element for
+  start and empty element tags, "/" followed by the name for end tags
+  and None for any other text.
+  Concatenating the texts gives back the input exactly.'''
+  buf = ''
+  eof = False
+  # How far into the construct at the start of buf has been looked at,
+  # and whether that is inside a quoted attribute value, so that a tag
+  # that is read a chunk at a time is only scanned once.
+  scan = 1
+  quote = None
+  while True:
+    if not eof and len(buf) < chunk_size:
+      more = reader.read(chunk_size)
+      eof = not more
+      buf += more
+    if not buf:
+      return
+    lt = buf.find('<')
+    if lt < 0:
+      yield None, buf
+      buf = ''
+      continue
+    if lt > 0:
+      yield None, buf[:lt]
+      buf = buf[lt:]
+      continue
+    end = None
+    for opener, closer in SKIPPED:
+      if buf.startswith(opener):
+        close = buf.find(closer, max(len(opener), scan - len(closer) + 1))
+        end = -1 if close < 0 else close + len(closer)
+        scan = len(buf)
+        name = None
+        break
+    else:
+      end, scan, quote = tag_end(buf, scan, quote)
+      if end >= 0:
+        m = TAG_RE.match(buf, 0, end)
+        if m:
+          name = m.group(1)
+        elif buf.startswith('</'):
+          name = '/' + buf[2:end - 1].strip()
+        else:
+          # DOCTYPE, or a stray <.
+          name = None
+    if end < 0:
+      # The construct at the start of buf isn't complete yet.
+      if eof:
+        yield None, buf
+        return
+      more = reader.read(chunk_size)
+      eof = not more
+      buf += more
+      continue
+    yield name, buf[:end]
+    buf = buf[end:]
+    scan = 1
+    quote = None
+
+
+# Escaping and unescaping attribute values.  Importing
+# xml.sax.saxutils takes longer than dogboning a small file, and its
+# unescape doesn't decode character references anyway.
+
+def escape_attribute(value):
+  return (value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+          .replace('"', "&quot;").replace("'", "&apos;"))
+
+# Matches a character reference (decimal in group 1, hexadecimal in
+# group 2) or one of the predefined entities (group 3).
+REFERENCE_RE = re.compile(r'&(?:#([0-9]+)|#[xX]([0-9a-fA-F]+)|(lt|gt|quot|apos|amp));')
+
+ENTITIES = {"lt": "<", "gt": ">", "quot": '"', "apos": "'", "amp": "&"}
+
+def unescape_reference(m):
+  if m.group(3):
+    return ENTITIES[m.group(3)]
+  try:
+    return chr(int(m.group(1)) if m.group(1) else int(m.group(2), 16))
+  except (ValueError, OverflowError):
+    # Not a character.  Leave it alone.
+    return m.group(0)
+
+def unescape_attribute(value):
+  if not "&" in value:
+    return value
+  return REFERENCE_RE.sub(unescape_reference, value)
+
+
+def stream_element(name, tag):
+  '''stream_element returns a minidom Element with the name and
+  attributes of the start tag tag.'''
+  elt = STREAM_DOCUMENT.createElement(name)
+  for m in ATTRIBUTE_RE.finditer(tag):
+    value = m.group(2) if m.group(2) is not None else m.group(3)
+    elt.setAttribute(m.group(1), unescape_attribute(value))
+  return elt
+
+
+def replace_attribute(tag, name, value):
+  '''replace_attribute returns tag with the value of attribute name
+  replaced by value.'''
+  for m in ATTRIBUTE_RE.finditer(tag):
+    if m.group(1) == name:
+      group = 2 if m.group(2) is not None else 3
+      return (tag[:m.start(group)] +
+              escape_attribute(value) +
+              tag[m.end(group):])
+  raise ValueError('No %s attribute in %s' % (name, tag))
+
+
+def shape_tag(tag, name, d):
+  '''shape_tag returns the start tag of a path element equivalent to
+  the start tag tag of a name element, with path data d.'''
+  geometry = SHAPE_GEOMETRY[name]
+  kept = []
+  last = 1 + len(name)
+  for m in ATTRIBUTE_RE.finditer(tag):
+    if m.group(1) in geometry:
+      kept.append(tag[last:m.start()])
+      last = m.end()
+  rest = tag[last:]
+  close = len(rest) - (2 if rest.endswith('/>') else 1)
+  return ('<path' + ''.join(kept) + rest[:close].rstrip() +
+          ' d="%s"' % escape_attribute(d) +
+          rest[close:])
+
+
+def dogbone_shape(elt, transform, rule, config=DEFAULT_CONFIG):
+  '''dogbone_shape adds dogbones chosen by the named rule and made as
+  the DogboneConfig config says to the path or shape elt.  It returns
+  the number of corners, the number of dogbones, the new path data,
+  which is None if there were no dogbones, and the CleanupStats of the
+  path.'''
+  ph = PathHolder(elt, transform, config)
+  ph.choose_dogbones(rule)
+  added = ph.make_dogbones()
+  d = None
+  if added:
+    with instrument.stage("serialize"):
+      d = ph.d()
+  return len(ph.corners), added, d, ph.cleanup_stats
+
+
+class ShapeCache(object):
+  '''ShapeCache holds the results of dogbone_shape for the most
+  recently seen shapes, keyed by shape_key, rule and cut type.  It
+  holds at most about size characters of path data, counting both the
+  geometry in the keys and the new path data, so that dogboning a
+  document with few repeated shapes doesn't keep all of its paths in
+  memory.  A shape bigger than that isn't cached at all.'''
+  def __init__(self, size):
+    self.size = size
+    self.used = 0
+    self.entries = OrderedDict()
+
+  def get(self, key):
+    '''get returns the cached result for key, or None.'''
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    self.entries.move_to_end(key)
+    return entry[1]
+
+  def put(self, key, result):
+    d = result[2]
+    cost = sum(len(k) for k in key[0][2:]) + (len(d) if d else 0)
+    if cost > self.size:
+      return
+    self.entries[key] = (cost, result)
+    self.used += cost
+    while self.used > self.size:
+      old_cost, old_result = self.entries.popitem(last=False)[1]
+      self.used -= old_cost
+
+
+# The size of the ShapeCache of dogbone_stream, in characters.
+SHAPE_CACHE_SIZE = 1 << 20
+
+def dogbone_stream(reader, writer, default_rule, class_rules={},
+                   config=DEFAULT_CONFIG):
+  '''dogbone_stream copies an SVG document from reader to writer,
+  adding dogbones chosen by rule and made as the DogboneConfig config
+  says to each path and basic shape.  It returns the number of
+  corners, the number of dogbones added and a CleanupStats for all of
+  the paths.'''
+  corner_count = 0
+  dogbone_count = 0
+  stats = CleanupStats()
+  # Shapes that are repeated with the same geometry, transform, rule
+  # and cut type are only dogboned once, unless they are far apart.
+  cache = ShapeCache(SHAPE_CACHE_SIZE)
+  # For each open element, its transform and the end tag to write for
+  # it if it has been converted to a path.
+  open_elements = [(IDENTITY, None)]
+  for name, text in svg_tokens(reader):
+    if name is None:
+      writer.write(text)
+      continue
+    if name.startswith('/'):
+      transform, end_tag = open_elements.pop()
+      writer.write(end_tag or text)
+      continue
+    transform = open_elements[-1][0]
+    end_tag = None
+    if name in SHAPE_GEOMETRY or "transform" in text:
+      elt = stream_element(name, text)
+      transform = element_transform(transform, elt)
+      if name in SHAPE_GEOMETRY and shape_d(elt):
+        rule = element_rule(elt, default_rule, class_rules)
+        # The cut type decides which corners are internal.
+        cut_type = (elt.getAttribute(CUT_TYPE_ATTRIBUTE) or
+                    config.default_cut_type)
+        key = (shape_key(elt, transform), rule, cut_type)
+        result = cache.get(key)
+        if result is None:
+          result = dogbone_shape(elt, transform, rule, config)
+          cache.put(key, result)
+        else:
+          instrument.count("cached_paths")
+        corners, added, d, path_stats = result
+        corner_count += corners
+        dogbone_count += added
+        stats.add(path_stats)
+        if d is not None:
+          if name == "path":
+            text = replace_attribute(text, "d", d)
+          else:
+            text = shape_tag(text, name, d)
+            end_tag = "</path>"
+    if not text.endswith('/>'):
+      open_elements.append((transform, end_tag))
+    writer.write(text)
+  return corner_count, dogbone_count, stats
+
+
 def output_name(input_name):
   base, ext = os.path.splitext(os.path.basename(input_name))
   return os.path.join(os.path.dirname(input_name),
       base + "-dogboned" + ext)
 
 
-def main():
-  global pc
-  global app
-  global cutter_diameter
-  global dogbone_base
-  global extra
-  args = parser.parse_args()
-  cutter_diameter = args.cutter_diameter
-  dogbone_base = args.dogbone_base
-  extra = args.extra
-  dom = xml.dom.minidom.parse(args.input_file)
-  pc = PathCollector()
+def expand_inputs(patterns):
+  '''expand_inputs returns the SVG files named by the command line
+  input_file arguments.  A directory names every SVG file below it.
+  Files we have written ourselves are not included.'''
+  files = []
+  for pattern in patterns:
+    if os.path.isdir(pattern):
+      matches = glob.glob(os.path.join(pattern, "**", "*.svg"), recursive=True)
+    else:
+      matches = glob.glob(pattern, recursive=True) or [pattern]
+    for f in sorted(matches):
+      if os.path.splitext(f)[0].endswith("-dogboned"):
+        continue
+      if not f in files:
+        files.append(f)
+  return files
+
+
+@contextlib.contextmanager
+def output_file(filename, newline=None):
+  '''output_file opens a temporary file next to filename for writing.
+  If the with statement completes the temporary file replaces
+  filename.  Otherwise it is removed, so that a failure doesn't leave
+  a partly written file that looks like a result.'''
+  temporary = "%s.%d.tmp" % (filename, os.getpid())
+  try:
+    with open(temporary, "w", encoding="utf-8", newline=newline) as writer:
+      yield writer
+    os.replace(temporary, filename)
+  except BaseException:
+    if os.path.exists(temporary):
+      os.remove(temporary)
+    raise
+
+
+def dogbone_file(input_file, default_rule=None, class_rules={},
+                 config=DEFAULT_CONFIG):
+  '''dogbone_file adds dogbones, made as the DogboneConfig config says,
+  to the paths of one SVG file and writes the result.  If default_rule
+  is None the user chooses the dogbones interactively.  Otherwise they
+  are chosen by rule and the file is streamed rather than read into
+  memory as a whole.  The return value is a tuple of input_file, the
+  number of corners, the number of dogbones added, the elapsed time in
+  seconds and a CleanupStats.'''
+  t0 = time.perf_counter()
+  instrument.count("files")
+  if default_rule is not None:
+    # newline='' so that line endings are copied unchanged.
+    with instrument.stage("stream"):
+      with open(input_file, "r", encoding="utf-8", newline="") as reader:
+        with output_file(output_name(input_file), newline="") as writer:
+          corner_count, dogbone_count, stats = dogbone_stream(
+            reader, writer, default_rule, class_rules, config)
+    return (input_file, corner_count, dogbone_count,
+            time.perf_counter() - t0, stats)
+  with instrument.stage("xml_parse"):
+    dom = xml.dom.minidom.parse(input_file)
+  pc = PathCollector(config)
   pc.gather(dom)
   app = GUI(pc)
   app.show()
-  app.run()
-  for ph in app.path_collector.paths:
-    for corner in ph.corners:
-      corner.make_dogbone()
-  # Now update the DOM paths.
-  pc.update()
-  # Write the new SVG file
-  out = open(output_name(args.input_file), "w")
-  dom.writexml(out, addindent="  ", newl="\n")
-  out.close()
+  with instrument.stage("gui"):
+    app.run()
+  corner_count = 0
+  dogbone_count = 0
+  stats = CleanupStats()
+  for ph in pc.paths:
+    corner_count += len(ph.corners)
+    dogbone_count += ph.make_dogbones()
+    stats.add(ph.cleanup_stats)
+  with instrument.stage("serialize"):
+    # Now update the DOM paths.
+    pc.update()
+    # Write the new SVG file
+    with output_file(output_name(input_file)) as out:
+      dom.writexml(out, addindent="  ", newl="\n")
+  return (input_file, corner_count, dogbone_count,
+          time.perf_counter() - t0, stats)
+
+
+def run_batch(input_files, jobs, default_rule, class_rules,
+              config=DEFAULT_CONFIG):
+  '''run_batch dogbones input_files using a pool of jobs worker
+  processes, reporting on each file as it finishes and then giving a
+  summary.  It returns the number of files that failed.'''
+  t0 = time.perf_counter()
+  corners = 0
+  dogbones = 0
+  failures = 0
+  stats = CleanupStats()
+  with instrument.executor(max_workers=jobs,
+                           tasks=len(input_files)) as executor:
+    futures = {
+      instrument.submit(executor, dogbone_file, f, default_rule, class_rules,
+                        config): f
+      for f in input_files
+    }
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        f, c, d, seconds, file_stats = instrument.result(future)
+      except Exception as err:
+        failures += 1
+        print("%s: FAILED: %s" % (futures[future], err), file=sys.stderr)
+        continue
+      corners += c
+      dogbones += d
+      stats.add(file_stats)
+      print("%s: %d corners, %d dogbones, %.3f s" % (f, c, d, seconds))
+      if file_stats.total():
+        print("%s: %s" % (f, file_stats))
+  print("%d files, %d failed, %d corners, %d dogbones in %.3f s" % (
+    len(input_files), failures, corners, dogbones, time.perf_counter() - t0))
+  if stats.total():
+    print(stats)
+  return failures
+
+
+# Self tests.  Each dogbones an SVG document and checks the result.
+# They are only run when asked for, with --test.
+
+def dogboned(document, default_rule='bisector', config=DEFAULT_CONFIG):
+  '''dogboned returns the result of dogbone_stream for document and
+  the document it wrote.'''
+  writer = io.StringIO()
+  result = dogbone_stream(io.StringIO(document), writer, default_rule,
+                          config=config)
+  return result, writer.getvalue()
+
+def test(name, document, expect_dogbones, default_rule='bisector',
+         config=DEFAULT_CONFIG):
+  try:
+    (corners, added, stats), output = dogboned(document, default_rule, config)
+  except ValueError as err:
+    print('FAIL', name, ':', err)
+    return
+  if added != expect_dogbones:
+    print('FAIL', name, ': expected %d dogbones, got %d\n    %s' % (
+      expect_dogbones, added, output))
+
+TEST_RECTANGLE = '<svg><path d="M 0,0 L 10,0 L 10,5 L 0,5 L 0,0"/></svg>'
+
+# An L shape, which has one concave corner and five convex ones.
+TEST_L_PATH = '<path shaper:cutType="%s" d="M 0,0 L 2,0 L 2,1 L 1,1 L 1,2 L 0,2 L 0,0 Z"/>'
+TEST_L = '<svg>' + TEST_L_PATH + '</svg>'
+
+# A turned row of mortises, enough for dogboneGeometries to use numpy.
+TEST_MORTISES = ' '.join(
+  'M %d,0 L %d,0 L %d,0.5 L %d,0.5 L %d,0' % (2 * i, 2 * i + 1, 2 * i + 1, 2 * i, 2 * i)
+  for i in range(VECTORIZE_THRESHOLD))
+
+def test_vectorized(name, d, default_rule, transform='rotate(30)'):
+  '''test_vectorized checks that the dogbones chosen by default_rule
+  for the path data d are exactly the same with and without numpy.'''
+  global VECTORIZE_THRESHOLD
+  if not load_numpy():
+    return
+  elt = STREAM_DOCUMENT.createElement('path')
+  elt.setAttribute('d', d)
+  elt.setAttribute('transform', transform)
+  threshold = VECTORIZE_THRESHOLD
+  results = []
+  try:
+    for VECTORIZE_THRESHOLD in (threshold, sys.maxsize):
+      ph = PathHolder(elt, parse_transform(transform))
+      ph.choose_dogbones(default_rule)
+      results.append(dogboneGeometries(ph.corners))
+  finally:
+    VECTORIZE_THRESHOLD = threshold
+  vectorized, scalar = results
+  if vectorized != scalar:
+    print('FAIL', name, ': %d of %d dogbones differ with numpy' % (
+      sum(v != s for v, s in zip(vectorized, scalar)), len(scalar)))
+
+def test_tokens(name, document, expect_names, chunk_size):
+  '''test_tokens checks the tag names svg_tokens finds in document when
+  it is read chunk_size characters at a time.'''
+  tokens = list(svg_tokens(io.StringIO(document), chunk_size))
+  names = [n for n, text in tokens if n is not None]
+  if names != expect_names or ''.join(t for n, t in tokens) != document:
+    print('FAIL', name, ': expected', expect_names, 'got', tokens)
+
+def test_shape_cache():
+  def key(d):
+    return (('path', IDENTITY, d), 'bisector', '')
+  def result(d):
+    return (4, 4, d, CleanupStats())
+  cache = ShapeCache(20)
+  cache.put(key('M 0,0'), result('M 0,0'))
+  cache.put(key('M 1,1'), result('M 1,1'))
+  cache.get(key('M 0,0'))
+  cache.put(key('M 2,2'), result(None))
+  cache.put(key('M 3,3 L 4,4 L 5,5 L 6,6'), result(None))
+  cached = [d for d in ('M 0,0', 'M 1,1', 'M 2,2', 'M 3,3 L 4,4 L 5,5 L 6,6')
+            if cache.get(key(d))]
+  if cached != ['M 0,0', 'M 2,2'] or cache.used != 15:
+    print('FAIL shape cache: cached', cached, 'using', cache.used)
+
+def test_cleanup(d, expect):
+  p = svg.path.parse_path(d)
+  cleanupPath(p)
+  if p.d() != svg.path.parse_path(expect).d():
+    print('FAIL cleanup', d, ': expected', expect, 'got', p.d())
+
+def run_tests():
+  import random
+  test_cleanup('M 0,0 L 1,0 L 1,0 L 1,1', 'M 0,0 L 1,0 L 1,1')
+  test_cleanup('M 0,0 L 1,0 L 2,0 L 2,1', 'M 0,0 L 2,0 L 2,1')
+  test_cleanup('M 0,0 L 1,0 L 1,1 L 1,0 L 0,0 Z', 'M 0,0 L 1,0 L 1,1')
+  test_cleanup('M 0,0 L 1,0 L 1,1 L 1,0 Z', 'M 0,0 L 1,0 L 1,1')
+  test_cleanup('M 0,0 L 1,0 L 1,1 L 1,1 L 0,1 Z', 'M 0,0 L 1,0 L 1,1 L 0,1 Z')
+  test_cleanup('M 0,0 L 1,0 L 1,1 L 0,1 L 1,1 Z', 'M 0,0 L 1,0 L 1,1 L 0,1 M 1,1 L 0,0')
+  for rule in ('bisector', 'first_leg', 'second_leg'):
+    for style in DOGBONE_STYLES:
+      test('rectangle %s %s' % (style, rule), TEST_RECTANGLE, 4, rule,
+           DogboneConfig(style=style))
+  test('rectangle extra', TEST_RECTANGLE, 4, 'first_leg', DogboneConfig(extra=0.05))
+  test('character references',
+       '<svg><path d="M 0&#44;0 L 10,0&#10;L 10&#x2c;5&#x20;L 0,5 L 0,0"/></svg>', 4)
+  test_shape_cache()
+  test('repeated shapes', '<svg>%s</svg>' % (TEST_L_PATH % 'inside' * 3), 15)
+  test('L inside', TEST_L % 'inside', 5)
+  test('L outside', TEST_L % 'outside', 1)
+  test('L online', TEST_L % 'online', 0)
+  test('L guide', TEST_L % 'guide', 0)
+  test('L unknown cut type', TEST_L % 'engrave', 0)
+  test('L default cut type', TEST_L.replace(' shaper:cutType="%s"', ''), 1,
+       config=DogboneConfig(default_cut_type='outside'))
+  test('L inside and outside',
+       '<svg>%s%s</svg>' % (TEST_L_PATH % 'outside', TEST_L_PATH % 'inside'), 6)
+  test_tokens('tags spanning chunks',
+              '<svg><!-- <g> --><path title="a > b" d="%s" class=\'c>\'/>'
+              '<g\n>x</g></svg>' % ('M 0,0 L 1,0 ' * 20),
+              ['svg', 'path', 'g', '/g', '/svg'], 7)
+  # Random paths with corners at every angle, seeded so that a failure
+  # can be reproduced.
+  rng = random.Random(1)
+  for rule in ('bisector', 'first_leg', 'second_leg'):
+    test_vectorized('mortises %s' % rule, TEST_MORTISES, rule)
+    for i in range(10):
+      points = [(rng.uniform(-100, 100), rng.uniform(-100, 100))
+                for j in range(2 * VECTORIZE_THRESHOLD)]
+      d = 'M ' + ' L '.join('%r,%r' % p for p in points)
+      test_vectorized('random path %d %s' % (i, rule), d, rule,
+                      'rotate(%r)' % rng.uniform(0, 360))
+
+
+def main():
+  args = parser.parse_args()
+  if not (args.input_file or args.test):
+    parser.error('No input_file given')
+  if args.test:
+    run_tests()
+  try:
+    config = DogboneConfig(cutter_diameter=args.cutter_diameter,
+                           dogbone_base=args.dogbone_base,
+                           extra=args.extra,
+                           style=args.style,
+                           snap_tolerance=args.tolerance,
+                           min_angle=args.min_angle,
+                           default_cut_type=args.cut_type)
+    check_rule_name(args.default_rule)
+    class_rules = dict(class_rule(arg) for arg in args.rule)
+  except ValueError as err:
+    parser.error(str(err))
+  input_files = expand_inputs(args.input_file)
+  with instrument.session("dogbones", args):
+    if args.batch:
+      if run_batch(input_files, args.jobs, args.default_rule, class_rules,
+                   config):
+        sys.exit(1)
+    else:
+      for f in input_files:
+        dogbone_file(f, config=config)
 
 
 if __name__ == "__main__":
   main()
-
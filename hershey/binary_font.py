@@ -0,0 +1,201 @@
+#!python3
+
+# A compact binary format for cleaned up Hershey fonts.
+#
+# A font as written by path_cleanup.py keeps each glyph as a list of
+# SVG path strings which every user must parse again.  Here the same
+# glyphs are stored as flat arrays so that a font can be memory mapped
+# and its glyphs used without any parsing.
+#
+# All values are little endian and 4 byte aligned:
+#
+#   header:   MAGIC, then glyph count, path count, point count and the
+#             length of the font name in bytes, each an unsigned 32 bit
+#             integer
+#   name:     the font name in UTF-8, padded with NULs to a multiple
+#             of 4 bytes
+#   advances: one float32 per glyph, the glyph's 'o' (X advance)
+#   glyphs:   glyph count + 1 uint32 offsets into paths.  The paths of
+#             glyph i are paths[glyphs[i]:glyphs[i+1]]
+#   paths:    path count + 1 uint32 offsets into points.  Each path
+#             is a Move to its first point followed by Lines to each
+#             of its other points
+#   points:   point count pairs of float32 X and Y coordinates
+
+import argparse
+import array
+import json
+import mmap
+import struct
+import sys
+
+# pip install svg.path
+import svg.path
+
+
+MAGIC = b'HFNT0001'
+
+HEADER = struct.Struct('<8sIIII')
+
+BINARY_FONT_SUFFIX = '.hfont'
+
+
+def d_points(d):
+  '''d_points returns the subpaths of the SVG path string d as lists
+  of complex points.  d may only have lines.'''
+  paths = []
+  points = None
+  for step in svg.path.parse_path(d):
+    if isinstance(step, svg.path.Move):
+      points = [step.end]
+      paths.append(points)
+    elif isinstance(step, svg.path.Line):
+      if points is None or points[-1] != step.start:
+        points = [step.start]
+        paths.append(points)
+      points.append(step.end)
+    else:
+      raise ValueError('Only lines are supported, not %r' % step)
+  return paths
+
+
+def glyph_points(glyph):
+  '''glyph_points returns the paths of a cleaned up glyph as lists of
+  complex points.'''
+  paths = []
+  for d in glyph['paths']:
+    paths.extend(d_points(d))
+  return paths
+
+
+def little_endian(a):
+  if sys.byteorder != 'little':
+    a = array.array(a.typecode, a)
+    a.byteswap()
+  return a.tobytes()
+
+
+def write_binary_font(font, filename):
+  '''write_binary_font writes font, as produced by path_cleanup.py,
+  to filename in the binary format described above.'''
+  advances = array.array('f')
+  glyphs = array.array('I', [0])
+  paths = array.array('I', [0])
+  points = array.array('f')
+  for glyph in font['chars']:
+    advances.append(glyph['o'])
+    for path in glyph_points(glyph):
+      for point in path:
+        points.append(point.real)
+        points.append(point.imag)
+      paths.append(len(points) // 2)
+    glyphs.append(len(paths) - 1)
+  name = font['name'].encode('utf-8')
+  with open(filename, 'wb') as out:
+    out.write(HEADER.pack(MAGIC, len(advances), len(paths) - 1,
+                          len(points) // 2, len(name)))
+    out.write(name + b'\0' * (-len(name) % 4))
+    for a in (advances, glyphs, paths, points):
+      out.write(little_endian(a))
+
+
+class BinaryFont(object):
+  '''BinaryFont provides access to a font file written by
+  write_binary_font.  The file is memory mapped and glyphs are read
+  from it on demand.'''
+  def __init__(self, filename):
+    with open(filename, 'rb') as f:
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, glyph_count, path_count, point_count, name_length = \
+      HEADER.unpack_from(self.mmap, 0)
+    if magic != MAGIC:
+      self.close()
+      raise ValueError('%s is not a binary font file' % filename)
+    offset = HEADER.size
+    self.name = self.mmap[offset : offset + name_length].decode('utf-8')
+    offset += name_length + (-name_length % 4)
+    self.advances, offset = self.section(offset, 'f', glyph_count)
+    self.glyphs, offset = self.section(offset, 'I', glyph_count + 1)
+    self.paths, offset = self.section(offset, 'I', path_count + 1)
+    self.points, offset = self.section(offset, 'f', 2 * point_count)
+
+  def section(self, offset, typecode, count):
+    end = offset + 4 * count
+    if sys.byteorder == 'little':
+      a = memoryview(self.mmap)[offset:end].cast(typecode)
+    else:
+      a = array.array(typecode, self.mmap[offset:end])
+      a.byteswap()
+    return a, end
+
+  def close(self):
+    for a in ('advances', 'glyphs', 'paths', 'points'):
+      view = getattr(self, a, None)
+      if isinstance(view, memoryview):
+        view.release()
+    self.mmap.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __len__(self):
+    return len(self.advances)
+
+  def glyph_index(self, character):
+    '''glyph_index returns the index of the glyph for character, or
+    None.  As in render_text.js, the glyphs start with "!".'''
+    index = ord(character) - 33
+    if index < 0 or index >= len(self):
+      return None
+    return index
+
+  def advance(self, index):
+    return self.advances[index]
+
+  def glyph_points(self, index):
+    '''glyph_points returns the paths of glyph index, each as a list of
+    (x, y) tuples.'''
+    result = []
+    points = self.points
+    for p in range(self.glyphs[index], self.glyphs[index + 1]):
+      result.append([(points[2 * i], points[2 * i + 1])
+                     for i in range(self.paths[p], self.paths[p + 1])])
+    return result
+
+  def glyph_paths(self, index):
+    '''glyph_paths returns the paths of glyph index as SVG path
+    strings, like the 'paths' of a glyph written by path_cleanup.py.'''
+    return [path_d(points) for points in self.glyph_points(index)]
+
+
+def path_d(points):
+  '''path_d returns an SVG path string for points, a sequence of (x, y)
+  tuples.'''
+  return ' '.join(('M %g,%g' if i == 0 else 'L %g,%g') % point
+                  for i, point in enumerate(points))
+
+
+def load_binary_font(filename):
+  return BinaryFont(filename)
+
+
+parser = argparse.ArgumentParser(description='Convert fonts written by path_cleanup.py to the binary font format.')
+
+parser.add_argument('json_font_file', type=str, nargs='+', action='store',
+                    help='A file as written by path_cleanup.py')
+
+
+def main():
+  args = parser.parse_args()
+  for f in args.json_font_file:
+    with open(f, 'r') as reader:
+      font = json.load(reader)
+    out = f[:-len('.json')] if f.endswith('.json') else f
+    write_binary_font(font, out + BINARY_FONT_SUFFIX)
+
+
+if __name__ == "__main__":
+  main()
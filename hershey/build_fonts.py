@@ -0,0 +1,209 @@
+#!python3
+
+# Rebuild the Hershey font files in the fonts directory:
+#
+#   extract:  <font>.json from the font catalogue (extract_font.py)
+#   cleanup:  <font>-cleaned_up.json and .hfont (path_cleanup.py)
+#   samples:  <font>.html (make_samples.py)
+#   index:    index.html and fonts.txt (fonts_index.py)
+#
+# The hashes of the inputs of each stage of each font are remembered
+# in BUILD_STATE_FILE.  A stage is only run again if one of its inputs
+# (including the code that implements it) has changed or one of its
+# outputs is missing.  Fonts are built in parallel.
+#
+# run as
+#
+#   python build_fonts.py [font ...]
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import os.path
+import sys
+import time
+
+import extract_font
+import fonts_index
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FONTS_DIR = os.path.join(HERE, 'fonts')
+
+BUILD_STATE_FILE = '.build_state.json'
+
+SAMPLES_TEMPLATE = os.path.join(HERE, 'make_samples-javascript.js')
+
+
+def file_hash(filename):
+  with open(filename, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+def code_hash(*modules):
+  return [file_hash(os.path.join(HERE, m)) for m in modules]
+
+
+def stage_outputs(stage, base):
+  if stage == 'cleanup':
+    return [base + '-cleaned_up.json', base + '-cleaned_up.hfont']
+  if stage == 'samples':
+    return [base + '.html']
+  raise ValueError('Unknown stage %r' % stage)
+
+
+def stage_inputs(stage, base, directory):
+  '''stage_inputs returns the hashes of everything the output of stage
+  depends on for the font whose files are named base.'''
+  raw = file_hash(os.path.join(directory, base + '.json'))
+  if stage == 'cleanup':
+    return [raw] + code_hash('path_cleanup.py', 'binary_font.py',
+                             os.path.join(os.pardir, 'common', 'snapping.py'))
+  if stage == 'samples':
+    return [raw, file_hash(SAMPLES_TEMPLATE)] + code_hash('make_samples.py')
+  raise ValueError('Unknown stage %r' % stage)
+
+
+def run_stage(stage, base, directory):
+  # These are imported here so that each worker process only loads what
+  # it uses.
+  if stage == 'cleanup':
+    import path_cleanup
+    font = path_cleanup.load_font(os.path.join(directory, base + '.json'))
+    path_cleanup.cleanup_font_paths(font)
+    path_cleanup.save_font(font, binary=True, directory=directory)
+  elif stage == 'samples':
+    import make_samples
+    font = make_samples.load_font(os.path.join(directory, base + '.json'))
+    make_samples.write_sample(font, os.path.join(directory, base + '.html'))
+
+
+STAGES = ['cleanup', 'samples']
+
+
+def build_font(base, directory, state, force=False):
+  '''build_font runs those stages for the font base whose inputs
+  differ from the hashes recorded in state, a dict mapping stage to
+  input hashes.  It returns base, the new state and a list of
+  (stage, seconds) for the stages that were run.'''
+  state = dict(state)
+  ran = []
+  for stage in STAGES:
+    inputs = stage_inputs(stage, base, directory)
+    outputs_exist = all(os.path.exists(os.path.join(directory, f))
+                        for f in stage_outputs(stage, base))
+    if not force and outputs_exist and state.get(stage) == inputs:
+      continue
+    t0 = time.perf_counter()
+    run_stage(stage, base, directory)
+    ran.append((stage, time.perf_counter() - t0))
+    state[stage] = inputs
+  return base, state, ran
+
+
+# The build state is a dict with 'fonts', mapping each font to a dict
+# from stage to the hashes of that stage's inputs, and 'index', the
+# fonts that the index files were last written for.
+
+def load_state(directory):
+  try:
+    with open(os.path.join(directory, BUILD_STATE_FILE), 'r') as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {'fonts': {}, 'index': None}
+
+
+def save_state(directory, state):
+  filename = os.path.join(directory, BUILD_STATE_FILE)
+  with open(filename + '.tmp', 'w') as f:
+    json.dump(state, f, indent=2, sort_keys=True)
+  os.replace(filename + '.tmp', filename)
+
+
+def listed_fonts(directory):
+  try:
+    with open(os.path.join(directory, fonts_index.TEXT_FILE_NAME), 'r') as f:
+      return [line.strip() for line in f if line.strip()]
+  except FileNotFoundError:
+    return []
+
+
+parser = argparse.ArgumentParser(description='Rebuild the Hershey font files that are out of date.')
+
+parser.add_argument('font', type=str, nargs='*', action='store',
+                    help='The file name base of a font, e.g. Sans_1-stroke.  ' +
+                    'The default is the fonts listed in ' + fonts_index.TEXT_FILE_NAME + '.')
+
+parser.add_argument('--directory', type=str, nargs=None, action='store',
+                    default=FONTS_DIR,
+                    help='The fonts directory.')
+
+parser.add_argument('--offline', action='store_true',
+                    help='Use the raw font JSON files already in the fonts directory ' +
+                    'rather than extracting them from the font catalogue.')
+
+parser.add_argument('--catalogue', type=str, nargs=None, action='store',
+                    help='A local copy of the font catalogue.')
+
+parser.add_argument('--cache_dir', type=str, nargs=None, action='store',
+                    default=extract_font.DEFAULT_CACHE_DIR,
+                    help='Where the downloaded font catalogue is cached.')
+
+parser.add_argument('--jobs', type=int, nargs=None, action='store',
+                    default=os.cpu_count(),
+                    help='The number of fonts to build at once.')
+
+parser.add_argument('--force', action='store_true',
+                    help='Rebuild everything.')
+
+
+def main():
+  args = parser.parse_args()
+  directory = args.directory
+  fonts = args.font or listed_fonts(directory)
+  if not args.offline:
+    # extract_font.save_font doesn't rewrite files that are unchanged.
+    catalogue = extract_font.load_fonts(args.catalogue, args.cache_dir)
+    by_base = {extract_font.font_file_base(f): f for f in catalogue.values()}
+    for base in fonts:
+      if not base in by_base:
+        print('%s is not in the font catalogue' % base, file=sys.stderr)
+        sys.exit(1)
+      extract_font.save_font(by_base[base], directory)
+  state = load_state(directory)
+  failed = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    futures = {
+      executor.submit(build_font, base, directory,
+                      state['fonts'].get(base, {}), args.force): base
+      for base in fonts
+    }
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        base, font_state, ran = future.result()
+      except Exception as err:
+        failed.append(futures[future])
+        print('%s: FAILED: %s' % (futures[future], err), file=sys.stderr)
+        continue
+      state['fonts'][base] = font_state
+      if ran:
+        print('%s: %s' % (base, ', '.join('%s %.2f s' % r for r in ran)))
+      else:
+        print('%s: up to date' % base)
+  indexed = sorted(set(listed_fonts(directory)) | set(fonts))
+  index_files = [fonts_index.INDEX_FILE_NAME, fonts_index.TEXT_FILE_NAME]
+  if (args.force or state['index'] != indexed or
+      not all(os.path.exists(os.path.join(directory, f)) for f in index_files)):
+    fonts_index.write_index(indexed, directory)
+    state['index'] = indexed
+    print('index rebuilt')
+  save_state(directory, state)
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,43 +1,120 @@
 #!python3
 
 import argparse
+import hashlib
 import json
+import os
+import os.path
 import sys
 import urllib.request
 
 
 ALL_FONTS = 'https://raw.githubusercontent.com/techninja/hersheytextjs/master/hersheytext.json'
 
-def load_fonts():
-  reader = urllib.request.urlopen(ALL_FONTS) 
-  fonts = json.load(reader)
+# Where a copy of ALL_FONTS is kept so that we need not download it
+# every time.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'hersheytext')
+
+CACHE_FILE_NAME = 'hersheytext.json'
+
+
+def content_hash(data):
+  return hashlib.sha256(data).hexdigest()
+
+
+def download(url):
+  reader = urllib.request.urlopen(url)
+  data = reader.read()
   reader.close()
-  return fonts
+  return data
+
+
+def write_file(filename, data):
+  # Write to a temporary file first so that an interrupted write
+  # doesn't leave a damaged cache.
+  tmp = filename + '.tmp'
+  with open(tmp, 'wb') as out:
+    out.write(data)
+  os.replace(tmp, filename)
+
+
+def cached_catalogue(cache_dir, refresh=False):
+  '''cached_catalogue returns the contents of ALL_FONTS, from the copy
+  in cache_dir if there is a good one there.  Otherwise, or if refresh
+  is true, it is downloaded and the cache updated.'''
+  cache_file = os.path.join(cache_dir, CACHE_FILE_NAME)
+  hash_file = cache_file + '.sha256'
+  if not refresh and os.path.exists(cache_file) and os.path.exists(hash_file):
+    with open(cache_file, 'rb') as f:
+      data = f.read()
+    with open(hash_file, 'r') as f:
+      expected = f.read().strip()
+    if content_hash(data) == expected:
+      return data
+    print('Cached %s is damaged, downloading it again.' % cache_file, file=sys.stderr)
+  data = download(ALL_FONTS)
+  os.makedirs(cache_dir, exist_ok=True)
+  write_file(cache_file, data)
+  write_file(hash_file, (content_hash(data) + '\n').encode('ascii'))
+  return data
+
+
+def load_fonts(catalogue=None, cache_dir=DEFAULT_CACHE_DIR, refresh=False):
+  '''load_fonts returns the fonts of the Hershey font catalogue.
+  catalogue can name a local copy of it.  Otherwise the copy cached in
+  cache_dir is used, downloading it first if need be or if refresh is
+  true.'''
+  if catalogue:
+    with open(catalogue, 'rb') as f:
+      data = f.read()
+  else:
+    data = cached_catalogue(cache_dir, refresh)
+  return json.loads(data.decode('utf-8'))
 
 font_name_translation = str.maketrans(' ', '_')
 
-def save_font(font):
-  name = font['name']
-  name = name.translate(font_name_translation)
-  out = open(name + '.json', mode='w')
-  json.dump(font, out)
-  out.close()
+def font_file_base(font):
+  return font['name'].translate(font_name_translation)
+
+def save_font(font, directory='.'):
+  filename = os.path.join(directory, font_file_base(font) + '.json')
+  data = json.dumps(font).encode('utf-8')
+  # Don't rewrite a font file that is already up to date.
+  if os.path.exists(filename):
+    with open(filename, 'rb') as f:
+      if f.read() == data:
+        return
+  with open(filename, 'wb') as out:
+    out.write(data)
 
 
 parser = argparse.ArgumentParser(description='Fetching Hershey vector fonts from ' + ALL_FONTS)
 
 parser.add_argument('operation', type=str, nargs=1, action='store',
-                    help='"list", "fetch" or "fetch_all"')
+                    help='"list", "fetch", "fetch_all" or "refresh".  ' +
+                    '"refresh" downloads the font catalogue again.')
 
 parser.add_argument('font_name', type=str, nargs='?', action='store',
                     help='The name of the font to extract')
 
+parser.add_argument('--catalogue', type=str, nargs=None, action='store',
+                    help='A local copy of the font catalogue to use instead of ' +
+                    'downloading it.')
+
+parser.add_argument('--cache_dir', type=str, nargs=None, action='store',
+                    default=DEFAULT_CACHE_DIR,
+                    help='Where the downloaded font catalogue is cached.')
+
 
 def main():
   args = parser.parse_args()
 
-  fonts = load_fonts()
   op = args.operation[0]
+  if op == 'refresh':
+    data = cached_catalogue(args.cache_dir, refresh=True)
+    print('%s: %d bytes, sha256 %s' % (ALL_FONTS, len(data), content_hash(data)))
+    return
+  fonts = load_fonts(args.catalogue, args.cache_dir)
   if op == 'list':
     print(' '.join(sorted(fonts.keys())))
   elif op == 'fetch':
@@ -63,4 +140,3 @@ def main():
 
 if __name__ == "__main__":
   main()
-
@@ -7,7 +7,6 @@
 import os
 import os.path
 import re
-from git import Repo      # pip install gitpython
 from yattag import Doc    # pip install yattag
 
 
@@ -42,10 +41,10 @@ def find_my_repository():
 def fonts_dir():
     return os.path.join(find_my_repository(), 'hershey', 'fonts')
 
-def main():
-    repo = Repo(find_my_repository())
-    assert not repo.bare
-    fonts = list_fonts(repo)
+def write_index(fonts, directory=None):
+    '''write_index writes the index files for the named fonts.'''
+    if directory is None:
+        directory = fonts_dir()
     doc, tag, text = Doc().tagtext()
     with tag('HTML'):
         with tag('HEAD'):
@@ -59,12 +58,20 @@ def main():
                     with tag('LI'):
                         with tag('A', href=sample_html_file(font)):
                             text(font)
-    with open(os.path.join(fonts_dir(), INDEX_FILE_NAME), 'w') as out:
+    with open(os.path.join(directory, INDEX_FILE_NAME), 'w') as out:
         out.write(doc.getvalue())
-    with open(os.path.join(fonts_dir(), TEXT_FILE_NAME), 'w') as out:
+    with open(os.path.join(directory, TEXT_FILE_NAME), 'w') as out:
         for font in fonts:
             out.write(font + '\n')
-    
+
+def main():
+    # Only needed here, so that build_fonts.py can use write_index
+    # without gitpython.
+    from git import Repo      # pip install gitpython
+    repo = Repo(find_my_repository())
+    assert not repo.bare
+    write_index(list_fonts(repo))
+
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,30 @@
 #!python3
 
 import argparse
+import functools
 import json
+import os
 import os.path
+import sys
 from yattag import Doc, indent    # pip install yattag
 
+# instrument.py is shared with dogbones.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import instrument
+
 
 parser = argparse.ArgumentParser(description='Make HTML sample files for Hershey fonts.')
 
 parser.add_argument('json_font_file', type=str, nargs='+', action='store',
                     help='A file as written by extract_font.py')
 
+parser.add_argument('--jobs', type=int, nargs=None, action='store',
+                    default=os.cpu_count(),
+                    help='The number of files to process at once.')
+
+instrument.add_arguments(parser)
+
 
 STYLESHEET = '''
 svg {
@@ -41,11 +55,28 @@ def pretty_path(pathtext):
 def contents(path):
   with open(path, "r") as f:
     return f.read()
-    
 
-def write_sample(font, output_file):
-  javascript = contents(os.path.join(os.path.dirname(__file__),
-                                     "make_samples-javascript.js"))
+
+@functools.lru_cache(maxsize=None)
+def javascript():
+  '''javascript returns the script included in each sample page.  It
+  is read only once.'''
+  return contents(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "make_samples-javascript.js"))
+
+
+# The table rows are written one at a time rather than building the
+# whole document and indenting it, so ROW_MARKER stands in for them
+# when laying out the rest of the page.
+ROW_MARKER = '<!-- glyph rows -->'
+
+# The depth of the rows in the indented page: html, body, table.
+ROW_INDENTATION = '      '
+
+
+def page_parts(font):
+  '''page_parts returns the indented text of the page before and after
+  the glyph table rows.'''
   doc, tag, text = Doc().tagtext()
   with tag('html'):
     with tag('head'):
@@ -57,57 +88,101 @@ def write_sample(font, output_file):
         # We could do this with a link, but I want the HTML file to be
         # self-contained.
         doc.asis("\n// ")
-        doc.cdata('\n' + javascript + '\n// ')
+        doc.cdata('\n' + javascript() + '\n// ')
         doc.asis("\n")
     with tag('body'):
       with tag('h1'):
         text(font['name'])
       with tag('table', id='glyphs', border='1'):
-        index = 0
-        for char in font['chars']:
-          with tag('tr'):
-            with tag('td', valign='top', align='right'):
-              # Column 1: indexes, character codes
-              text('%d.' % index)
-              doc.stag('br')
-              text('0x%x' % index)
-              doc.stag('br')
-              doc.asis('ASCII&nbsp;')
-              text('0x%02x' % (index + 33))
-              doc.stag('br')
-              text('"%c"' % chr(index + 33))
-            with tag('td',
-                     ('class', 'metrics'),
-                     valign='top', align='left'):
-              # Column 2: metrics.  Most are added by javascript code above.n
-              doc.asis("o:&nbsp;")
-              text('%d' % char['o'])
-              doc.stag('br')
-            with tag('td'):
-              # Column 3: SVG rendering of the glyph
-              with tag('svg', xmlns='http://www.w3.org/2000/svg'):
-                with tag('g'):
-                  doc.stag('path',
-                      ('d', char['d']),
-                      ('fill', 'none'),
-                      ('stroke','black'),
-                      ('stroke-width', '1px'))
-            with tag('td', valign='top', align='left'):
-              # Column 4: The SVG path
-              with tag('pre'):
-                text(pretty_path(char['d']))
-          index += 1
+        doc.asis(ROW_MARKER)
+  page = indent(doc.getvalue())
+  marker = page.index(ROW_MARKER)
+  before = page[:marker].rstrip(' ')
+  after = page[marker + len(ROW_MARKER):].lstrip('\n')
+  return before, after
+
+
+def glyph_row(index, char):
+  '''glyph_row returns the indented table row for one glyph.'''
+  doc, tag, text = Doc().tagtext()
+  with tag('tr'):
+    with tag('td', valign='top', align='right'):
+      # Column 1: indexes, character codes
+      text('%d.' % index)
+      doc.stag('br')
+      text('0x%x' % index)
+      doc.stag('br')
+      doc.asis('ASCII&nbsp;')
+      text('0x%02x' % (index + 33))
+      doc.stag('br')
+      text('"%c"' % chr(index + 33))
+    with tag('td',
+             ('class', 'metrics'),
+             valign='top', align='left'):
+      # Column 2: metrics.  Most are added by javascript code above.n
+      doc.asis("o:&nbsp;")
+      text('%d' % char['o'])
+      doc.stag('br')
+    with tag('td'):
+      # Column 3: SVG rendering of the glyph
+      with tag('svg', xmlns='http://www.w3.org/2000/svg'):
+        with tag('g'):
+          doc.stag('path',
+              ('d', char['d']),
+              ('fill', 'none'),
+              ('stroke','black'),
+              ('stroke-width', '1px'))
+    with tag('td', valign='top', align='left'):
+      # Column 4: The SVG path
+      with tag('pre'):
+        text(pretty_path(char['d']))
+  return indent_lines(indent(doc.getvalue()), ROW_INDENTATION)
+
+
+def indent_lines(text, prefix):
+  '''indent_lines adds prefix to each line of text except those that
+  continue the contents of a pre element.'''
+  lines = []
+  in_pre = False
+  for line in text.split('\n'):
+    lines.append(line if in_pre else prefix + line)
+    if '<pre>' in line:
+      in_pre = True
+    if '</pre>' in line:
+      in_pre = False
+  return '\n'.join(lines)
+
+
+def write_sample(font, output_file):
+  before, after = page_parts(font)
   with open(output_file, 'w') as out:
-    out.write(indent(doc.getvalue()));
+    out.write(before)
+    for index, char in enumerate(font['chars']):
+      out.write(glyph_row(index, char))
+      out.write('\n')
+    out.write(after)
+
+
+def sample_file(json_font_file):
+  with instrument.stage('load_font'):
+    font = load_font(json_font_file)
+  instrument.count('fonts')
+  instrument.count('glyphs', len(font['chars']))
+  out = os.path.splitext(json_font_file)[0] + '.html'
+  with instrument.stage('write_sample'):
+    write_sample(font, out)
 
 
 def main():
   args = parser.parse_args()
-  for f in args.json_font_file:
-    font = load_font(f)
-    out = os.path.splitext(f)[0] + '.html'
-    write_sample(font, out)
+  with instrument.session('make_samples', args):
+    with instrument.executor(max_workers=args.jobs or 1,
+                             tasks=len(args.json_font_file)) as executor:
+      futures = [instrument.submit(executor, sample_file, f)
+                 for f in args.json_font_file]
+      for future in futures:
+        # This raises any exception from writing the sample.
+        instrument.result(future)
 
 if __name__ == "__main__":
   main()
-
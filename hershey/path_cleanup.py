@@ -4,17 +4,49 @@
 # rendering with Shaper Origin.
 
 import argparse
+import heapq
 import json
+import os.path
+import sys
+from collections import defaultdict, deque
 
 # pip install svg.path
 import svg.path
 
+from binary_font import write_binary_font, BINARY_FONT_SUFFIX
 
-def cleanup_font_paths(font):
+# snapping.py and instrument.py are shared with dogbones.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import instrument
+import snapping
+
+
+# cleanup_font_paths replaces the 'd' path of each glyph of font with
+# a list of 'paths' from fix_path.  Unless optimize_travel is false
+# those paths are also reordered by order_paths.  It returns the total
+# pen-up travel of all of the glyphs before and after reordering.
+def cleanup_font_paths(font, optimize_travel=True,
+                       tolerance=snapping.DEFAULT_TOLERANCE):
+  before = 0
+  after = 0
   for char in font['chars']:
-    fixed = fix_path(svg.path.parse_path(char['d']))
+    with instrument.stage('parse_path'):
+      parsed = svg.path.parse_path(char['d'])
+    instrument.count('glyphs')
+    instrument.count('segments', len(parsed))
+    with instrument.stage('fix_path'):
+      fixed = fix_path(parsed, tolerance)
+    instrument.count('paths', len(fixed))
+    before += travel_distance(fixed)
+    if optimize_travel:
+      with instrument.stage('order_paths'):
+        fixed = order_paths(fixed)
+    after += travel_distance(fixed)
     del char['d']
-    char['paths'] = [f.d() for f in fixed]
+    with instrument.stage('serialize'):
+      char['paths'] = [f.d() for f in fixed]
+  return before, after
 
 
 # load_font reads a json file as written by extract_font.py
@@ -27,45 +59,73 @@ def load_font(filename):
 
 font_name_translation = str.maketrans(' ', '_')
 
-def save_font(font):
+# save_font writes font as JSON into directory.  If binary is true it
+# is also written in the binary format of binary_font.py.
+def save_font(font, binary=False, directory='.'):
   name = font['name']
-  name = name.translate(font_name_translation)
+  name = os.path.join(directory, name.translate(font_name_translation))
   out = open(name + '-cleaned_up' + '.json', mode='w')
   json.dump(font, out)
   out.close()
+  if binary:
+    write_binary_font(font, name + '-cleaned_up' + BINARY_FONT_SUFFIX)
+
+
+# Set CHECK_LINEGROUPS to True (or use --check_linegroups) to have every
+# LineGroup verify its whole structure after each change.  Otherwise
+# only the junction made by each change is checked.
+CHECK_LINEGROUPS = False
 
+# A LineGroup is a chain of lines each of which ends where the next one
+# starts.  The lines are kept in a deque so that lines can be added at
+# either end in constant time.
 
 class LineGroup(object):
   def __init__(self, lines):
-    self.lines = lines
+    self.lines = deque(lines)
     self.check()
   def __repr__(self):
-    return 'LineGroup(%r)' % self.lines
+    return 'LineGroup(%r)' % list(self.lines)
   def __str__(self):
     return '%d lines from %r to %r' % (len(self.lines), self.start, self.end)
   def __iter__(self):
     return(iter(self.lines))
+  def __reversed__(self):
+    return reversed(self.lines)
+  def __len__(self):
+    return len(self.lines)
   @property
   def start(self):
     return self.lines[0].start
   @property
   def end(self):
     return self.lines[-1].end
+  def closed(self):
+    return self.start == self.end
   def check(self):
-    for i in range(len(self.lines) - 1):
-      assert self.lines[i].end == self.lines[i+1].start, 'Malformed: %r' % self.lines
+    previous = None
+    for line in self.lines:
+      if previous is not None:
+        self.check_junction(previous, line)
+      previous = line
+  def check_junction(self, line1, line2):
+    assert line1.end == line2.start, 'Malformed: %r then %r in %r' % (line1, line2, self)
   def append(self, line):
+    if self.lines:
+      self.check_junction(self.lines[-1], line)
     self.lines.append(line)
-    self.check()
+    if CHECK_LINEGROUPS:
+      self.check()
   def prepend(self, line):
-    self.lines.insert(0, line)
-    self.check()
+    if self.lines:
+      self.check_junction(line, self.lines[0])
+    self.lines.appendleft(line)
+    if CHECK_LINEGROUPS:
+      self.check()
+  # merge splices the lines of other onto one end of this LineGroup,
+  # flipping them if necessary.  This takes time proportional to the
+  # length of other.
   def merge(self, other):
-    def reverse(l):
-      # list.reverse() is destructive and doesn't return its result.
-      rl = list(l)
-      rl.reverse()
-      return rl
     if self.end == other.start:
       for l in other.lines:
         self.append(l)
@@ -75,7 +135,7 @@ class LineGroup(object):
         self.prepend(flip(l))
       return True
     if self.end == other.end:
-      for l in reverse(other.lines):
+      for l in reversed(other.lines):
         self.append(flip(l))
       return True
     return False
@@ -110,38 +170,256 @@ def flipLine(step):
   return svg.path.Line(start=step.end, end=step.start)
 
 
+# EndpointIndex finds, for a LineGroup, the first other LineGroup (in
+# the order the groups were created) that LineGroup.merge would accept.
+# It maps each point to heaps of the numbers of the groups that start
+# or end there.  Entries are not removed when a group's endpoints
+# change or the group is merged away.  Instead stale entries are
+# discarded when they come to the top of a heap.
+
+class EndpointIndex(object):
+  def __init__(self, groups):
+    # groups is a list of LineGroups.  Merged away groups are replaced
+    # by None.
+    self.groups = groups
+    self.starts = defaultdict(list)
+    self.ends = defaultdict(list)
+    for i in range(len(groups)):
+      self.add(i)
+  def add(self, i):
+    heapq.heappush(self.starts[self.groups[i].start], i)
+    heapq.heappush(self.ends[self.groups[i].end], i)
+  def first(self, heap, attribute, point, exclude):
+    # Return the smallest current group number in heap other than
+    # exclude, or None.
+    excluded = False
+    found = None
+    while heap:
+      i = heap[0]
+      lg = self.groups[i]
+      if lg is None or getattr(lg, attribute) != point:
+        heapq.heappop(heap)
+        continue
+      if i == exclude:
+        heapq.heappop(heap)
+        excluded = True
+        continue
+      found = i
+      break
+    if excluded:
+      heapq.heappush(heap, exclude)
+    return found
+  def merge_candidate(self, i):
+    lg = self.groups[i]
+    candidates = [
+      self.first(self.starts[lg.end], 'start', lg.end, i),
+      self.first(self.starts[lg.start], 'start', lg.start, i),
+      self.first(self.ends[lg.end], 'end', lg.end, i)
+    ]
+    candidates = [c for c in candidates if c is not None]
+    if candidates:
+      return min(candidates)
+    return None
+
+
+# join_groups further combines the LineGroups that fix_path's merging
+# leaves separate.  This is the splicing step of Hierholzer's algorithm
+# for Eulerian trails: a closed LineGroup that touches another LineGroup
+# is spliced into it there, and two open LineGroups that share an
+# endpoint are joined.  Afterwards each connected part of the drawing
+# has as few LineGroups as possible: one for each pair of points where
+# an odd number of lines meet, or just one if there are no such points.
+def join_groups(groups):
+  while True:
+    # where maps each point to the places it occurs in groups.
+    where = defaultdict(list)
+    for g, lg in enumerate(groups):
+      for pos, line in enumerate(lg):
+        where[line.start].append((g, pos))
+      if not lg.closed():
+        where[lg.end].append((g, len(lg)))
+    # insertions maps a group number to (position, lines) pairs to
+    # be inserted into that group.
+    insertions = defaultdict(list)
+    consumed = set()
+    # Only one insertion is made at any position of a group in each
+    # pass so that the inserted lines stay connected.
+    used = set()
+    for c, lg in enumerate(groups):
+      if c in insertions:
+        continue
+      if lg.closed():
+        places = [(pos, line.start) for pos, line in enumerate(lg)]
+      else:
+        places = [(0, lg.start), (len(lg), lg.end)]
+      found = None
+      for cpos, point in places:
+        for g, pos in where[point]:
+          if g == c or g in consumed or (g, pos) in used:
+            continue
+          if lg.closed():
+            # Rotate the loop to start and end at point.
+            lines = list(lg)
+            lines = lines[cpos:] + lines[:cpos]
+          elif pos == 0 and not groups[g].closed():
+            # Put lg in front of groups[g], ending at point.
+            lines = lg if cpos > 0 else reversed_lines(lg)
+          elif pos == len(groups[g]) and not groups[g].closed():
+            # Put lg after groups[g], starting at point.
+            lines = lg if cpos == 0 else reversed_lines(lg)
+          else:
+            continue
+          found = (g, pos, lines)
+          break
+        if found:
+          break
+      if found:
+        g, pos, lines = found
+        insertions[g].append((pos, lines))
+        consumed.add(c)
+        used.add((g, pos))
+    if not consumed:
+      return groups
+    result = []
+    for g, lg in enumerate(groups):
+      if g in consumed:
+        continue
+      if g in insertions:
+        old = list(lg)
+        lines = []
+        previous = 0
+        for pos, inserted in sorted(insertions[g], key=lambda i: i[0]):
+          lines.extend(old[previous:pos])
+          lines.extend(inserted)
+          previous = pos
+        lines.extend(old[previous:])
+        lg = LineGroup(lines)
+      result.append(lg)
+    groups = result
+
+
+def reversed_lines(lines):
+  return [flip(l) for l in reversed(lines)]
+
+
 # fix_path transforms a parsed SVG path to an equivalent one that is
 # easier to cut on Shaper Origin.
 # The result is a list of parsed paths to avoid confusing Shaper Origin.
-def fix_path(parsed):
-  # Expect every element to be a Line:
-  # Arrange the lines so that they line up end to end
-  linegroups = [LineGroup([step]) for step in parsed]
-  i = 0
-  while True:
-    if i >= len(linegroups):
-      break
-    lg1 = linegroups[i]
-    merge = False
-    for lg2 in linegroups:
-      if lg1 == lg2:
-        continue
-      if lg1.merge(lg2):
-        linegroups.remove(lg2)
-        merge = True
-        break
-    if not merge:
-      i += 1
+#
+# Lines are merged into LineGroups in the same order that repeatedly
+# scanning the list of LineGroups for one that LineGroup.merge accepts
+# would produce, but using an EndpointIndex rather than scanning.  A
+# group that has absorbed a group that preceded it in that list gives
+# up its turn to the next group, as it would in the list scan.
+#
+# Endpoints within tolerance of each other are first snapped together
+# so that LineGroup.merge and EndpointIndex can match them exactly.
+def fix_path(parsed, tolerance=snapping.DEFAULT_TOLERANCE):
+  # Expect every element to be a Line.  Moves just separate the
+  # subpaths of the input, which we are about to rearrange anyway.
+  lines = [step for step in parsed if not isinstance(step, svg.path.Move)]
+  snapping.snap_lines(lines, tolerance)
+  linegroups = [LineGroup([step]) for step in lines]
+  index = EndpointIndex(linegroups)
+  # following and preceding link the surviving groups in order.
+  following = list(range(1, len(linegroups))) + [None]
+  preceding = [None] + list(range(len(linegroups) - 1))
+  i = 0 if linegroups else None
+  while i is not None:
+    j = index.merge_candidate(i)
+    if j is None:
+      i = following[i]
       continue
+    linegroups[i].merge(linegroups[j])
+    linegroups[j] = None
+    index.add(i)
+    if preceding[j] is not None:
+      following[preceding[j]] = following[j]
+    if following[j] is not None:
+      preceding[following[j]] = preceding[j]
+    if j < i:
+      i = following[i]
+  linegroups = join_groups([lg for lg in linegroups if lg is not None])
   result = []
   for lg in linegroups:
-    p = svg.path.Path()
+    p = svg.path.Path(svg.path.Move(to=lg.start))
     result.append(p)
     for l in lg:
       p.append(l)
   return result
 
 
+# Pen-up travel
+
+# The order and direction of the paths that fix_path returns is
+# arbitrary.  Time the cutter spends moving from the end of one path to
+# the start of the next is wasted, so we reorder the paths, reversing
+# some of them, to reduce that travel.
+
+# travel_distance returns the total distance travelled between paths
+# when cutting paths in order, starting from position.
+def travel_distance(paths, position=0j):
+  distance = 0.0
+  for p in paths:
+    distance += abs(p[0].start - position)
+    position = p[-1].end
+  return distance
+
+
+def reverse_path(p):
+  lines = [step for step in p if not isinstance(step, svg.path.Move)]
+  reversed_path = svg.path.Path(svg.path.Move(to=lines[-1].end))
+  for l in reversed_lines(lines):
+    reversed_path.append(l)
+  return reversed_path
+
+
+# order_paths returns paths reordered to reduce travel_distance.  A
+# nearest neighbor tour from position is improved by 2-opt moves, each
+# of which reverses a run of the tour, flipping each path in it.  At
+# most max_passes passes of 2-opt are made.
+def order_paths(paths, position=0j, max_passes=20):
+  # The tour is a list of [path, reversed] pairs.
+  def start(entry):
+    return entry[0][-1].end if entry[1] else entry[0][0].start
+  def end(entry):
+    return entry[0][0].start if entry[1] else entry[0][-1].end
+  remaining = list(paths)
+  tour = []
+  here = position
+  while remaining:
+    best = None
+    for i, p in enumerate(remaining):
+      for rev in (False, True):
+        d = abs(start([p, rev]) - here)
+        if best is None or d < best[0]:
+          best = (d, i, rev)
+    entry = [remaining.pop(best[1]), best[2]]
+    tour.append(entry)
+    here = end(entry)
+  for unused in range(max_passes):
+    improved = False
+    for i in range(len(tour)):
+      before = position if i == 0 else end(tour[i - 1])
+      for j in range(i, len(tour)):
+        # Consider reversing tour[i:j+1].  Travel within that run is
+        # unchanged.
+        old = abs(start(tour[i]) - before)
+        new = abs(end(tour[j]) - before)
+        if j + 1 < len(tour):
+          following = start(tour[j + 1])
+          old += abs(following - end(tour[j]))
+          new += abs(following - start(tour[i]))
+        if new < old - 1e-9:
+          run = tour[i:j + 1]
+          run.reverse()
+          tour[i:j + 1] = [[p, not rev] for p, rev in run]
+          improved = True
+    if not improved:
+      break
+  return [reverse_path(p) if rev else p for p, rev in tour]
+
+
 def test(p, expect):
   def noMove(p):
     return [step for step in p
@@ -152,27 +430,62 @@ def test(p, expect):
   if not (fixed == expectp):
     print('FAIL', p, ': \n    ', expectp, '\n    ', fixed, '\n\n')
 
-test('M0,0 L1,0  M1,1 L1,0', ['M0,0 L1,0 L1,1']) # end - end
-test('M0,0 L0,1  M0,1 L1,1', ['M0,0 L0,1 L1,1']) # end - start
-test('M0,0 L1,0  M0,0 L1,1', ['M1,1 L0,0 L1,0']) # start - start
-test('M4,1 L4,22 M4,1 L12,22 M20,1 L12,22 M20,1 L20,22',
-     ['M4,22 L4,1 L12,22 L20,1 L20,22'])
-test('M15,8 L15,22 M15,11 L13,9 11,8 8,8 6,9 4,11 3,14 3,16 4,19 6,21 8,22 11,22 13,21 15,19',
-     ['M15,8 L15,22', 'M15,11 L13,9 L11,8 L8,8 L6,9 L4,11 L3,14 L3,16 L4,19 L6,21 L8,22 L11,22 L13,21 L15,19'])
+
+# The self tests are only run when asked for, with --test, so that
+# importing this module stays quick.
+def run_tests():
+  test('M0,0 L1,0  M1,1 L1,0', ['M0,0 L1,0 L1,1']) # end - end
+  test('M0,0 L0,1  M0,1 L1,1', ['M0,0 L0,1 L1,1']) # end - start
+  test('M0,0 L1,0  M0,0 L1,1', ['M1,1 L0,0 L1,0']) # start - start
+  test('M4,1 L4,22 M4,1 L12,22 M20,1 L12,22 M20,1 L20,22',
+       ['M4,22 L4,1 L12,22 L20,1 L20,22'])
+  test('M0,0 L1,0  M1.00001,0 L1,1', ['M0,0 L1,0 L1,1']) # nearly end - start
+  test('M15,8 L15,22 M15,11 L13,9 11,8 8,8 6,9 4,11 3,14 3,16 4,19 6,21 8,22 11,22 13,21 15,19',
+       ['M15,8 L15,22', 'M15,11 L13,9 L11,8 L8,8 L6,9 L4,11 L3,14 L3,16 L4,19 L6,21 L8,22 L11,22 L13,21 L15,19'])
 
 
 parser = argparse.ArgumentParser(description='Cleanup the paths in a Hershey font JSON file for Shaper Origin.')
 
-parser.add_argument('json_font_file', type=str, nargs='+', action='store',
+parser.add_argument('json_font_file', type=str, nargs='*', action='store',
                     help='A file as written by extract_font.py')
 
+parser.add_argument('--binary', action='store_true',
+                    help='Also write the font in the binary format of binary_font.py.')
+
+parser.add_argument('--keep_order', action='store_true',
+                    help='Do not reorder the paths of each glyph to reduce pen-up travel.')
+
+parser.add_argument('--tolerance', type=float, nargs=None, action='store',
+                    default=snapping.DEFAULT_TOLERANCE,
+                    help='Endpoints closer together than this are taken to be the same point.')
+
+parser.add_argument('--check_linegroups', action='store_true',
+                    help='Check the structure of every line group after each change (slow).')
+
+parser.add_argument('--test', action='store_true',
+                    help='Run the self tests first.')
+
+instrument.add_arguments(parser)
+
 
 def main():
+  global CHECK_LINEGROUPS
   args = parser.parse_args()
-  for f in args.json_font_file:
-    font = load_font(f)
-    cleanup_font_paths(font)
-    save_font(font)
+  if not (args.json_font_file or args.test):
+    parser.error('No json_font_file given')
+  CHECK_LINEGROUPS = args.check_linegroups
+  if args.test:
+    run_tests()
+  with instrument.session('path_cleanup', args):
+    for f in args.json_font_file:
+      with instrument.stage('load_font'):
+        font = load_font(f)
+      instrument.count('fonts')
+      before, after = cleanup_font_paths(font, not args.keep_order, args.tolerance)
+      print('%s: pen-up travel %.1f before ordering, %.1f after' % (
+        font['name'], before, after))
+      with instrument.stage('save_font'):
+        save_font(font, args.binary)
 
 
 if __name__ == "__main__":
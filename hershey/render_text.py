@@ -0,0 +1,247 @@
+#!python3
+
+# Render text as SVG paths using a Hershey font.  This follows
+# renderText in render_text.js so that text can be rendered in bulk
+# without a web browser.
+
+import argparse
+import functools
+import json
+import os.path
+import re
+
+# pip install svg.path
+import svg.path
+
+from binary_font import BinaryFont, BINARY_FONT_SUFFIX, d_points, path_d
+from path_cleanup import order_paths
+
+
+# The scale render_text.js applies to the rendered text.
+DEFAULT_SCALE = 4 * 1.0 / 90
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+
+
+# load_font reads a font file as written by path_cleanup.py,
+# extract_font.py or binary_font.py.
+def load_font(filename):
+  if filename.endswith(BINARY_FONT_SUFFIX):
+    return BinaryFont(filename)
+  with open(filename, 'r') as reader:
+    return json.load(reader)
+
+
+KERNING_RE = re.compile('([-a-zA-Z0-9!@#$%^&*()_+={}|<>,./]{2}) +([0-9]+(.[0-9]*)?)')
+
+# parse_kerning parses the contents of a kerning file the way
+# parseKerning in render_text.js does.  The result maps each two
+# character string to the additional X advance between those
+# characters.
+def parse_kerning(kerning):
+  k = {}
+  for line in kerning.split('\n'):
+    m = KERNING_RE.search(line)
+    if m:
+      k[m.group(1)] = float(m.group(2))
+  return k
+
+
+def load_kerning(filename):
+  with open(filename, 'r') as reader:
+    return parse_kerning(reader.read())
+
+
+def comment(text):
+  # "--" may not appear in an XML comment.
+  return '<!-- %s -->' % text.replace('--', '- -')
+
+
+class Glyph(object):
+  '''Glyph is a glyph of a font, ready to be placed.'''
+  def __init__(self, advance, paths):
+    # The X advance of the glyph, like 'o' in the font files.
+    self.advance = advance
+    # A tuple of the glyph's subpaths, each a tuple of complex points.
+    self.paths = paths
+    # The path strings, for placing the glyph with a transform.
+    self.d = tuple(path_d((p.real, p.imag) for p in points)
+                   for points in paths)
+
+
+class TextRenderer(object):
+  '''TextRenderer renders strings using one font and kerning table.
+  Glyphs are parsed when first used and kept in an LRU cache of
+  cache_size glyphs.  The paths of a character placed at a given X
+  position are cached too.'''
+  def __init__(self, font, kerning={}, scale=DEFAULT_SCALE, cache_size=512):
+    self.font = font
+    self.kerning = dict(kerning)
+    self.scale = scale
+    self.glyph = functools.lru_cache(maxsize=cache_size)(self.lookup_glyph)
+    self.placed = functools.lru_cache(maxsize=8 * cache_size)(self.place_glyph)
+    # The X advance of a space is that of "n", as in render_text.js.
+    en = self.glyph('n')
+    self.space_advance = en.advance if en else 0
+
+  def lookup_glyph(self, character):
+    '''lookup_glyph returns the Glyph for character, or None.  Use
+    glyph rather than calling this directly.'''
+    if isinstance(self.font, BinaryFont):
+      index = self.font.glyph_index(character)
+      if index is None:
+        return None
+      return Glyph(self.font.advance(index),
+                   tuple(tuple(complex(x, y) for x, y in points)
+                         for points in self.font.glyph_points(index)))
+    glyphs = self.font['chars']
+    index = ord(character) - 33
+    if index < 0 or index >= len(glyphs) or not glyphs[index]:
+      return None
+    glyph = glyphs[index]
+    paths = []
+    for d in glyph['paths'] if 'paths' in glyph else [glyph['d']]:
+      paths.extend(d_points(d))
+    return Glyph(glyph['o'], tuple(tuple(p) for p in paths))
+
+  def place_glyph(self, character, x):
+    '''place_glyph returns the paths of the glyph for character moved
+    to X position x, as svg.path.Paths.  Use placed rather than
+    calling this directly.'''
+    result = []
+    for points in self.glyph(character).paths:
+      points = [p + x for p in points]
+      path = svg.path.Path(svg.path.Move(to=points[0]))
+      for start, end in zip(points, points[1:]):
+        path.append(svg.path.Line(start, end))
+      result.append(path)
+    return tuple(result)
+
+  def layout(self, text):
+    '''layout returns a list of (character, x) pairs giving the
+    unscaled X position of each character of text that has a glyph.
+    Characters without a glyph are left out.'''
+    x = 0
+    previous = ''
+    result = []
+    for char in text:
+      if char == ' ':
+        x += self.space_advance
+        previous = char
+        continue
+      x += self.kerning.get(previous + char, 0)
+      glyph = self.glyph(char)
+      if glyph is None:
+        continue
+      result.append((char, x))
+      x += glyph.advance
+      previous = char
+    return result
+
+  def paths(self, text, optimize_travel=False):
+    '''paths returns the paths of text as svg.path.Paths in font
+    units, before scaling.  If optimize_travel is true they
+    are reordered across the whole string to reduce the cutter's
+    travel between paths.'''
+    result = []
+    for char, x in self.layout(text):
+      result.extend(self.placed(char, x))
+    if optimize_travel:
+      result = order_paths(result)
+    return result
+
+  def svg_group(self, text, optimize_travel=False):
+    '''svg_group returns an SVG g element, as a string, for text.
+    Like renderText in render_text.js, each character gets its own g
+    element translated to its position.  If optimize_travel is true the
+    paths are instead ordered across the whole string and positioned
+    directly.'''
+    lines = ['<g transform="scale(%g)">' % self.scale, comment(text)]
+    if optimize_travel:
+      for p in self.paths(text, True):
+        lines.append('<path d="%s"/>' % p.d())
+    else:
+      for char, x in self.layout(text):
+        lines.append('<g transform="translate(%g, 0)">' % x)
+        lines.append(comment(char))
+        for d in self.glyph(char).d:
+          lines.append('<path d="%s"/>' % d)
+        lines.append('</g>')
+    lines.append('</g>')
+    return '\n'.join(lines)
+
+  def svg_document(self, text, optimize_travel=False):
+    '''svg_document returns a complete SVG document, as a string,
+    containing text.  The viewBox fits the rendered paths.'''
+    xs = []
+    ys = []
+    for p in self.paths(text):
+      for step in p:
+        xs.append(step.end.real * self.scale)
+        ys.append(step.end.imag * self.scale)
+    if xs:
+      viewbox = '%g %g %g %g' % (min(xs), min(ys),
+                                 max(xs) - min(xs), max(ys) - min(ys))
+    else:
+      viewbox = '0 0 0 0'
+    return '\n'.join([
+      '<svg xmlns="%s" viewBox="%s">' % (SVG_NAMESPACE, viewbox),
+      '<style>path { fill: none; stroke: black; stroke-width: 0.01; }</style>',
+      self.svg_group(text, optimize_travel),
+      '</svg>',
+      ''])
+
+
+parser = argparse.ArgumentParser(description='Render text as SVG using a Hershey font.')
+
+parser.add_argument('--font', type=str, nargs=None, action='store', required=True,
+                    help='A font file as written by path_cleanup.py or binary_font.py.')
+
+parser.add_argument('--kerning', type=str, nargs=None, action='store',
+                    help='A kerning file.  By default the .kerning file next to the font file is used if there is one.')
+
+parser.add_argument('--names', type=str, nargs=None, action='store',
+                    help='A file with one string to render per line.')
+
+parser.add_argument('--output_dir', type=str, nargs=None, action='store', default='.',
+                    help='Where to write the SVG files.')
+
+parser.add_argument('--optimize_travel', action='store_true',
+                    help='Order the paths of each string to reduce pen-up travel.')
+
+parser.add_argument('text', type=str, nargs='*', action='store',
+                    help='Strings to render.')
+
+
+FILE_NAME_RE = re.compile('[^A-Za-z0-9_-]+')
+
+def output_file_name(text, number):
+  return '%04d-%s.svg' % (number, FILE_NAME_RE.sub('_', text).strip('_'))
+
+
+def default_kerning_file(font_file):
+  # Font files are named like Sans_1-stroke-cleaned_up.json and
+  # kerning files like Sans_1-stroke.kerning.
+  base = os.path.splitext(font_file)[0]
+  if base.endswith('-cleaned_up'):
+    base = base[:-len('-cleaned_up')]
+  return base + '.kerning'
+
+
+def main():
+  args = parser.parse_args()
+  kerning_file = args.kerning or default_kerning_file(args.font)
+  kerning = load_kerning(kerning_file) if os.path.exists(kerning_file) else {}
+  renderer = TextRenderer(load_font(args.font), kerning)
+  texts = list(args.text)
+  if args.names:
+    with open(args.names, 'r') as reader:
+      texts.extend(line.strip() for line in reader if line.strip())
+  for number, text in enumerate(texts):
+    out = os.path.join(args.output_dir, output_file_name(text, number))
+    with open(out, 'w') as f:
+      f.write(renderer.svg_document(text, args.optimize_travel))
+
+
+if __name__ == "__main__":
+  main()
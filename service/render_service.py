@@ -0,0 +1,380 @@
+#!python3
+
+# A local HTTP service for dogboning SVG files and rendering text with
+# the Hershey fonts, so that a web page can use them without running
+# a script for each request.  The fonts, their kerning tables and their
+# parsed glyphs are loaded once, when the service starts.
+#
+#   POST /dogbone   the request body is an SVG document; the response
+#                   is that document with dogbones added, as by
+#                   dogbones.py --batch.  Query parameters are named
+#                   like dogbones.py's arguments: default_rule,
+#                   cutter_diameter, dogbone_base, extra, style,
+#                   min_angle, cut_type, tolerance and rule=CLASS=RULE,
+#                   which may be repeated.
+#
+#   GET /render     an SVG document of the text parameter rendered in
+#                   the font parameter, as by render_text.py.  With
+#                   optimize_travel=1 the paths are reordered to reduce
+#                   pen-up travel.
+#
+#   GET /fonts      a JSON list of the fonts that /render can use.
+#
+# Dogboning and rendering are done by a bounded pool of worker threads
+# (or processes, with --processes) so that the service keeps accepting
+# connections while they run.  When --queue requests are already
+# waiting for a worker, further ones are refused with status 503.
+# Documents that can't be dogboned, such as those with malformed path
+# data, get status 400.
+#
+# run as
+#
+#   python render_service.py [--port 8765]
+
+import argparse
+import asyncio
+import concurrent.futures
+import glob
+import io
+import json
+import os
+import os.path
+import sys
+import time
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+FONTS_DIR = os.path.join(REPO, 'hershey', 'fonts')
+
+sys.path.append(os.path.join(REPO, 'dogbones'))
+sys.path.append(os.path.join(REPO, 'hershey'))
+
+import dogbones
+import render_text
+
+
+parser = argparse.ArgumentParser(description='Serve dogboning and Hershey text rendering over HTTP.')
+
+parser.add_argument('--host', type=str, nargs=None, action='store',
+                    default='127.0.0.1',
+                    help='The address to listen on.')
+
+parser.add_argument('--port', type=int, nargs=None, action='store',
+                    default=8765,
+                    help='The port to listen on.')
+
+parser.add_argument('--fonts_dir', type=str, nargs=None, action='store',
+                    default=FONTS_DIR,
+                    help='Where the cleaned up fonts and their kerning files are.')
+
+parser.add_argument('--workers', type=int, nargs=None, action='store',
+                    default=os.cpu_count() or 1,
+                    help='The number of requests to work on at once.')
+
+parser.add_argument('--processes', action='store_true',
+                    help='Use worker processes rather than threads, so that ' +
+                    'requests are worked on in parallel on several CPUs.')
+
+parser.add_argument('--queue', type=int, nargs=None, action='store',
+                    default=64,
+                    help='The most requests that may wait for a worker.')
+
+parser.add_argument('--max_body', type=int, nargs=None, action='store',
+                    default=16 << 20,
+                    help='The largest request body accepted, in bytes.')
+
+parser.add_argument('--allow_origin', type=str, nargs=None, action='store',
+                    help='Allow web pages from this origin (or * for any) ' +
+                    'to make requests.')
+
+parser.add_argument('--quiet', action='store_true',
+                    help="Don't log each request.")
+
+
+class HTTPError(Exception):
+  '''HTTPError is raised to respond to a request with an error
+  status.'''
+  def __init__(self, status, message):
+    super().__init__(status, message)
+    self.status = status
+    self.message = message
+
+
+REASONS = {
+  200: 'OK',
+  204: 'No Content',
+  400: 'Bad Request',
+  404: 'Not Found',
+  405: 'Method Not Allowed',
+  411: 'Length Required',
+  413: 'Payload Too Large',
+  500: 'Internal Server Error',
+  503: 'Service Unavailable',
+}
+
+
+# Fonts
+
+# RENDERERS maps the name of each font, like Sans_1-stroke, to a
+# render_text.TextRenderer for it.  It is filled by load_fonts in the
+# main process and in each worker process.
+RENDERERS = {}
+
+CLEANED_UP_SUFFIX = '-cleaned_up.json'
+
+def load_fonts(fonts_dir):
+  '''load_fonts loads every cleaned up font in fonts_dir, with its
+  kerning, and parses all of its glyphs.'''
+  for f in sorted(glob.glob(os.path.join(fonts_dir, '*' + CLEANED_UP_SUFFIX))):
+    kerning_file = render_text.default_kerning_file(f)
+    kerning = (render_text.load_kerning(kerning_file)
+               if os.path.exists(kerning_file) else {})
+    renderer = render_text.TextRenderer(render_text.load_font(f), kerning)
+    for code in range(33, 127):
+      renderer.glyph(chr(code))
+    RENDERERS[os.path.basename(f)[:-len(CLEANED_UP_SUFFIX)]] = renderer
+  # numpy is otherwise imported by the first big request.
+  dogbones.load_numpy()
+
+
+# Requests.  Each handler takes the parsed query string and the request
+# body and returns the content type and body of the response and a
+# dict of any additional headers.  Handlers other than those marked
+# inline are run by the worker pool.
+
+ROUTES = {}
+
+def route(method, path, inline=False):
+  def defineRoute(f):
+    ROUTES[(method, path)] = (f, inline)
+    return f
+  return defineRoute
+
+
+def parameter(query, name, default=None, convert=str):
+  '''parameter returns the value of the query parameter name converted
+  by convert, or default if there is none.'''
+  values = query.get(name)
+  if not values:
+    return default
+  try:
+    return convert(values[-1])
+  except ValueError:
+    raise HTTPError(400, 'Bad %s: %r' % (name, values[-1]))
+
+
+def flag(value):
+  return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+@route('GET', '/fonts', inline=True)
+def fonts_request(query, body):
+  return 'application/json', json.dumps(sorted(RENDERERS)).encode('utf-8'), {}
+
+
+@route('GET', '/render')
+def render_request(query, body):
+  name = parameter(query, 'font', 'Sans_1-stroke')
+  renderer = RENDERERS.get(name)
+  if renderer is None:
+    raise HTTPError(404, 'No font %r, expected one of %s' % (
+      name, ', '.join(sorted(RENDERERS))))
+  text = parameter(query, 'text', '')
+  document = renderer.svg_document(
+    text, parameter(query, 'optimize_travel', False, flag))
+  return 'image/svg+xml', document.encode('utf-8'), {}
+
+
+@route('POST', '/dogbone')
+def dogbone_request(query, body):
+  default = dogbones.DEFAULT_CONFIG
+  try:
+    config = dogbones.DogboneConfig(
+      cutter_diameter=parameter(query, 'cutter_diameter', default.cutter_diameter, float),
+      dogbone_base=parameter(query, 'dogbone_base', default.dogbone_base, float),
+      extra=parameter(query, 'extra', default.extra, float),
+      style=parameter(query, 'style', default.style),
+      snap_tolerance=parameter(query, 'tolerance', default.snap_tolerance, float),
+      min_angle=parameter(query, 'min_angle', default.min_angle, float),
+      default_cut_type=parameter(query, 'cut_type', default.default_cut_type))
+    default_rule = parameter(query, 'default_rule', 'bisector')
+    dogbones.check_rule_name(default_rule)
+    class_rules = dict(dogbones.class_rule(arg) for arg in query.get('rule', []))
+    reader = io.StringIO(body.decode('utf-8'))
+    writer = io.StringIO()
+    # Malformed path data raises svg.path's InvalidPathError, which is a
+    # ValueError, as are bad transforms and dogbones that can't be made.
+    corners, added, stats = dogbones.dogbone_stream(
+      reader, writer, default_rule, class_rules, config)
+  except ValueError as err:
+    raise HTTPError(400, str(err))
+  return ('image/svg+xml', writer.getvalue().encode('utf-8'),
+          {'X-Corners': corners, 'X-Dogbones': added})
+
+
+def handle(method, path, query, body):
+  '''handle runs the handler for a request.'''
+  if not (method, path) in ROUTES:
+    if any(p == path for m, p in ROUTES):
+      raise HTTPError(405, '%s is not allowed for %s' % (method, path))
+    raise HTTPError(404, 'Nothing at %s' % path)
+  return ROUTES[(method, path)][0](query, body)
+
+
+# HTTP
+
+async def read_request(reader, max_body):
+  '''read_request reads an HTTP request from reader.  It returns the
+  method, the target, the HTTP version, a dict of the headers, with
+  lower case names, and the body, or None at the end of the input.'''
+  line = await reader.readline()
+  if not line:
+    return None
+  try:
+    method, target, version = line.decode('latin-1').split()
+  except ValueError:
+    raise HTTPError(400, 'Bad request line')
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      break
+    name, sep, value = line.decode('latin-1').partition(':')
+    if not sep:
+      raise HTTPError(400, 'Bad header')
+    headers[name.strip().lower()] = value.strip()
+  if 'transfer-encoding' in headers:
+    raise HTTPError(411, 'Chunked requests are not supported')
+  try:
+    length = int(headers.get('content-length', '0'))
+  except ValueError:
+    raise HTTPError(400, 'Bad Content-Length')
+  if length > max_body:
+    raise HTTPError(413, 'The request body is larger than %d bytes' % max_body)
+  body = await reader.readexactly(length) if length > 0 else b''
+  return method, target, version, headers, body
+
+
+def keep_alive(version, headers):
+  connection = headers.get('connection', '').lower()
+  if version == 'HTTP/1.0':
+    return connection == 'keep-alive'
+  return connection != 'close'
+
+
+class RenderService(object):
+  '''RenderService answers HTTP requests, having handle run them in
+  executor, which has the given number of workers.  At most queue_size
+  requests may wait for a worker.'''
+  def __init__(self, executor, workers, queue_size, max_body,
+               allow_origin=None, log=True):
+    self.executor = executor
+    self.workers = workers
+    self.queue_size = queue_size
+    self.max_body = max_body
+    self.allow_origin = allow_origin
+    self.log = log
+    # The number of requests given to executor that haven't finished,
+    # both those being worked on and those waiting for a worker.
+    self.pending = 0
+
+  async def respond_to(self, method, target, body):
+    '''respond_to returns the status, content type, body and additional
+    headers of the response to a request.'''
+    url = urllib.parse.urlsplit(target)
+    query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+    if method == 'OPTIONS' and self.allow_origin:
+      # A CORS preflight request.
+      return 204, None, b'', {
+        'Access-Control-Allow-Methods': 'GET, POST',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Expose-Headers': 'X-Corners, X-Dogbones',
+      }
+    if ROUTES.get((method, url.path), (None, False))[1]:
+      return (200,) + handle(method, url.path, query, body)
+    if self.pending - self.workers >= self.queue_size:
+      raise HTTPError(503, 'Too many requests are waiting')
+    self.pending += 1
+    try:
+      result = await asyncio.get_running_loop().run_in_executor(
+        self.executor, handle, method, url.path, query, body)
+    finally:
+      self.pending -= 1
+    return (200,) + result
+
+  async def handle_connection(self, reader, writer):
+    peer = writer.get_extra_info('peername')
+    try:
+      while True:
+        t0 = time.perf_counter()
+        alive = True
+        method = target = '-'
+        try:
+          request = await read_request(reader, self.max_body)
+          if request is None:
+            break
+          method, target, version, headers, body = request
+          alive = keep_alive(version, headers)
+          status, content_type, body, extra_headers = await self.respond_to(
+            method, target, body)
+        except HTTPError as err:
+          status, content_type, body, extra_headers = (
+            err.status, 'text/plain; charset=utf-8',
+            (err.message + '\n').encode('utf-8'), {})
+          # The rest of a bad request can't be relied on.
+          alive = alive and err.status not in (400, 411, 413)
+        except (asyncio.IncompleteReadError, ConnectionError):
+          break
+        except Exception as err:
+          status, content_type, body, extra_headers = (
+            500, 'text/plain; charset=utf-8',
+            ('%s: %s\n' % (err.__class__.__name__, err)).encode('utf-8'), {})
+        lines = ['HTTP/1.1 %d %s' % (status, REASONS.get(status, ''))]
+        if content_type:
+          lines.append('Content-Type: %s' % content_type)
+        lines.append('Content-Length: %d' % len(body))
+        lines.append('Connection: %s' % ('keep-alive' if alive else 'close'))
+        if self.allow_origin:
+          lines.append('Access-Control-Allow-Origin: %s' % self.allow_origin)
+        lines.extend('%s: %s' % header for header in extra_headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        if self.log:
+          print('%s %s %s %d %.1f ms' % (peer and peer[0], method, target, status,
+                                         (time.perf_counter() - t0) * 1000))
+        if not alive:
+          break
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def serve(self, host, port):
+    server = await asyncio.start_server(self.handle_connection, host, port)
+    print('Listening on http://%s:%d/' % (host, port), flush=True)
+    async with server:
+      await server.serve_forever()
+
+
+def main():
+  args = parser.parse_args()
+  load_fonts(args.fonts_dir)
+  if args.processes:
+    executor = concurrent.futures.ProcessPoolExecutor(
+      max_workers=args.workers, initializer=load_fonts,
+      initargs=(args.fonts_dir,))
+  else:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+  service = RenderService(executor, args.workers, args.queue, args.max_body,
+                          args.allow_origin, not args.quiet)
+  try:
+    asyncio.run(service.serve(args.host, args.port))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+  main()